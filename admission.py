@@ -0,0 +1,131 @@
+import os
+import math
+import threading
+import time
+from functools import wraps
+from collections import OrderedDict
+from flask import request, abort
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+from models import Post, estimate_within_radius
+from spatial_index import spatial_index
+
+
+class AdmissionConstants:
+    # largest radius (in meters) of a radius query, /select-area included
+    MAX_RADIUS = int(os.getenv('MAX_RADIUS', 50000))
+    # radius queries sort every row inside the circle, refuse those the
+    # planner expects to match more rows than this
+    MAX_ESTIMATED_ROWS = int(os.getenv('MAX_ESTIMATED_ROWS', 50000))
+    # expensive queries per second and burst per client (user or address).
+    # Buckets live in each worker process: a client's requests spread over
+    # all WEB_CONCURRENCY workers, so each worker refills at RATE / workers,
+    # which adds up to about RATE. The burst is per worker, a client can burst
+    # up to BURST x workers before the rate applies.
+    RATE = float(os.getenv('SPATIAL_QUERY_RATE', 5))
+    BURST = int(os.getenv('SPATIAL_QUERY_BURST', 20))
+    WORKERS = int(os.getenv('WEB_CONCURRENCY', 1))
+    # expensive queries running at once per worker; keep it below the
+    # database pool size so cheap requests always find a connection
+    MAX_CONCURRENT = int(os.getenv('SPATIAL_QUERY_CONCURRENCY', 3))
+    # exports streaming at once per worker; each holds a thread and a
+    # database connection until its last row is sent
+    MAX_EXPORTS = int(os.getenv('EXPORT_CONCURRENCY', 1))
+    # seconds a request waits for a free slot before it gets a 503
+    QUEUE_TIMEOUT = 0.1
+    # clients whose buckets are remembered, least recently seen are dropped
+    MAX_CLIENTS = 10000
+
+
+class TokenBuckets:
+    """Thread-safe token bucket per client: a bucket holds up to burst tokens
+    and refills at rate tokens per second, every request takes one"""
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        """Take a token, return 0 if there was one, otherwise the seconds until there is"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+buckets = TokenBuckets(AdmissionConstants.RATE / AdmissionConstants.WORKERS, AdmissionConstants.BURST, AdmissionConstants.MAX_CLIENTS)
+slots = threading.BoundedSemaphore(AdmissionConstants.MAX_CONCURRENT)
+export_slots = threading.BoundedSemaphore(AdmissionConstants.MAX_EXPORTS)
+
+def client_key():
+    # behind a proxy remote_addr is the proxy's address unless TRUSTED_PROXIES
+    # is set, then ProxyFix (see create_app) takes it from X-Forwarded-For
+    if current_user.is_authenticated:
+        return 'user:%s' % current_user.id
+    return 'addr:%s' % request.remote_addr
+
+def admit(semaphore):
+    """Take a token of the client (429 if there is none) and a slot of
+    semaphore (503 if none frees up within QUEUE_TIMEOUT)"""
+    wait = buckets.take(client_key())
+    if wait:
+        raise TooManyRequests(retry_after=math.ceil(wait))
+    if not semaphore.acquire(timeout=AdmissionConstants.QUEUE_TIMEOUT):
+        raise ServiceUnavailable(retry_after=1)
+
+def expensive_query(view):
+    """Admit a view only within the rate of its client (429 otherwise) and
+    while fewer than MAX_CONCURRENT such views run in this worker (503 if no
+    slot frees up within QUEUE_TIMEOUT), so a burst of big queries is turned
+    away at once instead of queueing on the connection pool"""
+    @wraps(view)
+    def admitted(*args, **kwargs):
+        admit(slots)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            slots.release()
+    return admitted
+
+def streamed_export(view):
+    """expensive_query for views returning a streamed Response, with their
+    own MAX_EXPORTS slots: a slot is held until the response is closed (all
+    of it sent or the client gone), not just until the view returns"""
+    @wraps(view)
+    def admitted(*args, **kwargs):
+        admit(export_slots)
+        try:
+            response = view(*args, **kwargs)
+        except BaseException:
+            export_slots.release()
+            raise
+        response.call_on_close(export_slots.release)
+        return response
+    return admitted
+
+def check_radius(model, lat, lng, radius):
+    """abort(400) for radius queries over the radius cap or expected to match
+    more than MAX_ESTIMATED_ROWS rows. With the spatial index the estimate
+    is the number of points it has to measure, which costs it as much time
+    as the rows cost PostGIS."""
+    if not 0 < radius <= AdmissionConstants.MAX_RADIUS:
+        abort(400, 'radius must be between 1 and %d meters' % AdmissionConstants.MAX_RADIUS)
+    if spatial_index.ready():
+        index = spatial_index.posts if model is Post else spatial_index.locations
+        estimate = index.estimate_within_radius(lat, lng, radius)
+    else:
+        estimate = estimate_within_radius(model, lat, lng, radius)
+    if estimate > AdmissionConstants.MAX_ESTIMATED_ROWS:
+        abort(400, 'too many items in this area, choose a smaller radius')
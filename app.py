@@ -1,28 +1,109 @@
 import os
 import sys
-from flask import Flask, request, abort, jsonify, render_template, url_for, flash, redirect, session
+import json
+import queue
+import itertools
+import click
+from flask import Flask, Response, stream_with_context, request, abort, jsonify, render_template, url_for, flash, redirect, session
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import traceback
 from forms import NewLocationForm, AddPosts, RegistrationForm, LoginForm, SelectAreaForm
-from models import setup_db, Location, db_drop_and_create_all, Post, db, User
+from models import setup_db, read_replica, UnitOfWork, Location, PostDensity, db_drop_and_create_all, Post, db, User, PagingConstants, feed_cache, user_cache, data_version, IngestConstants, insert_in_chunks, write_behind, backfill_post_locations
 from sqlalchemy.exc import IntegrityError
 import hashlib
 from flask_login import login_user, logout_user, login_required, current_user, login_manager, LoginManager
-import timeago, datetime
-
-
-def create_app(test_config=None):
-    # create and configure the app
+import datetime
+from cache import LRUCache, CacheConstants, query_id
+from metrics import init_metrics
+from events import item_events, EventConstants
+from spatial_index import spatial_index
+from snapshot import write_snapshot, SnapshotConstants
+from export import ExportConstants, FORMATS, export_filters
+from admission import expensive_query, streamed_export, check_radius
+from httpcache import versioned, init_http_cache, build_assets
+
+
+def read_items(lines):
+    """Yield the items of a batch import given as a JSON array or as NDJSON
+    (one object per line). NDJSON is read lazily; a line that is not valid
+    JSON is passed on as its error so it is reported for its own index."""
+    lines = iter(lines)
+    for first_line in lines:
+        if first_line.strip():
+            break
+    else:
+        return
+
+    if first_line.lstrip().startswith('['):
+        yield from json.loads(first_line + ''.join(lines))
+        return
+
+    for line in itertools.chain([first_line], lines):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError('invalid JSON: %s' % e)
+
+
+def search_area(args):
+    """Return (lat, lng, radius) of an optional search area given as
+    lat, lng and radius (in meters) query arguments, raise ValueError if
+    only some of them are given"""
+    if not any(args.get(name) for name in ('lat', 'lng', 'radius')):
+        return None, None, None
+    return float(args.get('lat')), float(args.get('lng')), float(args.get('radius'))
+
+
+def create_app(test_config=None, mode=None):
+    """Create and configure the app. In production mode (mode='production' or
+    APP_MODE=production) SECRET_KEY must come from the environment, so that all
+    gunicorn workers sign sessions with the same key. Nothing here opens a
+    database connection, so the app can be preloaded before workers fork
+    (see gunicorn.conf.py)."""
+    mode = mode or os.getenv('APP_MODE', 'development')
     app = Flask(__name__)
+    app.config['APP_MODE'] = mode
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    if test_config is not None:
+        app.config.update(test_config)
+
+    if not app.config['SECRET_KEY']:
+        if mode == 'production':
+            raise RuntimeError('SECRET_KEY must be set in production mode')
+        # fine for a single development process, but sessions do not survive
+        # a restart and are not shared between processes
+        app.config['SECRET_KEY'] = os.urandom(32)
+
+    # number of proxies in front of the app (e.g. 1 for nginx), whose
+    # X-Forwarded-For / -Proto headers are trusted for request.remote_addr etc.
+    trusted_proxies = int(os.getenv('TRUSTED_PROXIES', 0))
+    if trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies)
+
     setup_db(app)
     CORS(app)
 
-    SECRET_KEY = os.urandom(32)
-    app.config['SECRET_KEY'] = SECRET_KEY
-
     """ uncomment at the first time running the app. Then comment back so you do not erase db content over and over """
     #db_drop_and_create_all()
     
+    # pages of /select-area results, keyed by (query id, cursor)
+    area_results = LRUCache(CacheConstants.AREA_RESULTS_SIZE, CacheConstants.AREA_RESULTS_TTL)
+
+    init_metrics(app, caches={
+        'area_results': area_results,
+        'feed': feed_cache,
+        'users': user_cache
+    })
+
+    # loaded in the background by each worker (SPATIAL_INDEX=1), see spatial_index.py
+    spatial_index.init_app(app)
+
+    # response compression and fingerprinted assets, see httpcache.py
+    init_http_cache(app)
+
     login_manager = LoginManager(app)
     login_manager.login_view = 'login'
     login_manager.login_message_category = 'info'
@@ -69,8 +150,7 @@ def create_app(test_config=None):
                 content=form.content.data,
                 geom=Location.point_representation(latitude=latitude, longitude=longitude)
             )
-            db.session.add(post)
-            db.session.commit()
+            post.insert()
 
             flash(f'New post added!', 'success')
             return redirect(url_for('map'))
@@ -90,6 +170,18 @@ def create_app(test_config=None):
             description = request.args.get('description')
             user_id = int(request.args.get('user_id')) # <<<< added
 
+            if request.args.get('defer'):
+                # written later by write_behind, together with other deferred items
+                item = {'type': 'location', 'lat': latitude, 'lng': longitude,
+                        'description': description, 'user_id': user_id}
+                queued = write_behind.submit(app, item)
+                return jsonify(
+                    {
+                        "success": queued,
+                        "queued": queued
+                    }
+                ), 202 if queued else 503
+
             location = Location(
                 description=description,
                 geom=Location.point_representation(latitude=latitude, longitude=longitude),
@@ -109,20 +201,302 @@ def create_app(test_config=None):
             app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
             abort(500)
 
+    @app.route("/api/store_items", methods=['POST'])
+    def store_items():
+        # a JSON array, or NDJSON (one item per line) with Content-Type application/x-ndjson
+        try:
+            items = list(read_items(request.get_data(as_text=True).splitlines(True)))
+        except ValueError:
+            abort(400)
+
+        try:
+            # one transaction per chunk, not one for the whole request
+            results = list(insert_in_chunks(items))
+            return jsonify(
+                {
+                    "success": True,
+                    "inserted": sum(1 for result in results if 'id' in result),
+                    "failed": sum(1 for result in results if 'error' in result),
+                    "results": results
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.cli.command('import-items')
+    @click.argument('path', type=click.File('r'))
+    @click.option('--chunk-size', default=IngestConstants.CHUNK_SIZE, help='Items per transaction.')
+    def import_items(path, chunk_size):
+        """Import locations and posts from a JSON array or NDJSON file."""
+        inserted = failed = 0
+        for result in insert_in_chunks(read_items(path), chunk_size):
+            if 'error' in result:
+                failed += 1
+                click.echo('item %d: %s' % (result['index'], result['error']), err=True)
+            else:
+                inserted += 1
+        click.echo('%d inserted, %d failed' % (inserted, failed))
+
+    @app.cli.command('link-posts')
+    @click.option('--batch-size', default=10000, help='Post ids per transaction.')
+    def link_posts(batch_size):
+        """Link posts without a location to the location at their point."""
+        linked = sum(backfill_post_locations(batch_size))
+        click.echo('%d posts linked' % linked)
+
+    @app.cli.command('rebuild-density')
+    def rebuild_density():
+        """Recount the post density grid from all posts."""
+        PostDensity.rebuild()
+        click.echo('post density rebuilt')
+
+    @app.cli.command('export-snapshot')
+    @click.argument('path')
+    @click.option('--chunk-size', default=SnapshotConstants.CHUNK_SIZE, help='Rows per round trip.')
+    def export_snapshot(path, chunk_size):
+        """Write all locations and posts to a columnar snapshot file."""
+        locations, posts = write_snapshot(path, chunk_size)
+        click.echo('%d locations, %d posts written to %s' % (locations, posts, path))
+
+    @app.cli.command('build-assets')
+    def build_static_assets():
+        """Fingerprint and precompress the files in static/ for /assets."""
+        manifest = build_assets(app.static_folder)
+        click.echo('%d assets built, restart the app to serve them' % len(manifest))
+
+    @app.cli.command('export-posts')
+    @click.argument('output', type=click.File('w'))
+    @click.option('--format', 'export_format', type=click.Choice(list(FORMATS)), default='ndjson')
+    @click.option('--south', type=float)
+    @click.option('--west', type=float)
+    @click.option('--north', type=float)
+    @click.option('--east', type=float)
+    @click.option('--lat', type=float)
+    @click.option('--lng', type=float)
+    @click.option('--radius', type=float, help='Meters around --lat/--lng.')
+    @click.option('--since', help='ISO 8601 date, inclusive.')
+    @click.option('--until', help='ISO 8601 date, exclusive.')
+    @click.option('--chunk-size', default=ExportConstants.CHUNK_SIZE, help='Rows per round trip.')
+    def export_posts(output, export_format, chunk_size, **args):
+        """Export posts in an area or date range as NDJSON or GeoJSON (- for stdout)."""
+        try:
+            filters = export_filters(args)
+        except (TypeError, ValueError) as e:
+            raise click.UsageError('incomplete or malformed filter: %s' % e)
+        for chunk in FORMATS[export_format](Post.export(chunk_size=chunk_size, **filters)):
+            output.write(chunk)
+
     @app.route("/api/get_items_in_radius")
+    @read_replica
+    @versioned
+    @expensive_query
     def get_items_in_radius():
         try:
             latitude = float(request.args.get('lat'))
             longitude = float(request.args.get('lng'))
             radius = int(request.args.get('radius'))
+        except (TypeError, ValueError):
+            abort(400)
+        check_radius(Location, latitude, longitude, radius)
+
+        try:
+            cursor = request.args.get('cursor')
+
+            locations, next_cursor = Location.get_items_within_radius(latitude, longitude, radius, cursor)
+            return jsonify(
+                {
+                    "success": True,
+                    "results": locations,
+                    "next_cursor": next_cursor
+                }
+            ), 200
+        except ValueError:
+            # a malformed cursor
+            abort(400)
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.route("/api/nearest")
+    @read_replica
+    @versioned
+    def nearest():
+        try:
+            latitude = float(request.args.get('lat'))
+            longitude = float(request.args.get('lng'))
+            k = min(int(request.args.get('k', 10)), PagingConstants.API_PAGE_SIZE)
+            model = Post if request.args.get('type') == 'post' else Location
+
+            return jsonify(
+                {
+                    "success": True,
+                    "results": model.nearest(latitude, longitude, max(k, 1))
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.route("/api/stream")
+    def stream():
+        # Server-Sent Events: every new location or post inside the box, as
+        # soon as it is committed. Each open stream holds a worker thread (a
+        # greenlet with gevent workers), so a page keeps a single stream open,
+        # reopened for the new box when it loads another area.
+        try:
+            south = float(request.args.get('south'))
+            west = float(request.args.get('west'))
+            north = float(request.args.get('north'))
+            east = float(request.args.get('east'))
+        except (TypeError, ValueError):
+            abort(400)
+
+        subscription = item_events.subscribe(app, south, west, north, east, limit=EventConstants.MAX_STREAMS)
+        if subscription is None:
+            # EventSource gives up on a 503, the map keeps working without live updates
+            abort(503)
+
+        def events():
+            try:
+                yield 'retry: 5000\n\n'
+                while True:
+                    try:
+                        item = subscription.get(timeout=EventConstants.KEEPALIVE)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    yield 'event: %s\ndata: %s\n\n' % (item['type'], json.dumps(item))
+            finally:
+                item_events.unsubscribe(subscription)
+
+        return Response(events(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+
+    @app.route("/api/export")
+    @read_replica
+    @streamed_export
+    def export():
+        # every post matching the filters (see export.export_filters), streamed
+        # as it is read from the database
+        export_format = request.args.get('format', 'ndjson')
+        try:
+            filters = export_filters(request.args)
+        except (TypeError, ValueError):
+            abort(400)
+        if export_format not in FORMATS:
+            abort(400)
+
+        posts = Post.export(chunk_size=ExportConstants.CHUNK_SIZE, **filters)
+        return Response(stream_with_context(FORMATS[export_format](posts)),
+            mimetype=ExportConstants.MIMETYPES[export_format],
+            headers={
+                'Content-Disposition': 'attachment; filename=posts.%s' % export_format,
+                'X-Accel-Buffering': 'no'
+            })
+
+    @app.route("/api/get_items_in_bbox")
+    @read_replica
+    @versioned
+    def get_items_in_bbox():
+        try:
+            south = float(request.args.get('south'))
+            west = float(request.args.get('west'))
+            north = float(request.args.get('north'))
+            east = float(request.args.get('east'))
+            # ids of the markers the client already shows, comma separated
+            known = request.args.get('known', '')
+            known_ids = set(int(id) for id in known.split(',') if id)
+
+            added, removed, truncated = Location.get_items_in_bbox_diff(south, west, north, east, known_ids)
+            return jsonify(
+                {
+                    "success": True,
+                    "added": added,
+                    "removed": removed,
+                    "truncated": truncated
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.route("/api/get_clusters")
+    @read_replica
+    @versioned
+    def get_clusters():
+        try:
+            south = float(request.args.get('south'))
+            west = float(request.args.get('west'))
+            north = float(request.args.get('north'))
+            east = float(request.args.get('east'))
+            zoom = int(request.args.get('zoom'))
+
+            clusters = Location.get_clusters(south, west, north, east, zoom)
+            return jsonify(
+                {
+                    "success": True,
+                    "clusters": clusters
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.route("/api/density")
+    @read_replica
+    @versioned
+    def density():
+        try:
+            south = float(request.args.get('south'))
+            west = float(request.args.get('west'))
+            north = float(request.args.get('north'))
+            east = float(request.args.get('east'))
+            zoom = int(request.args.get('zoom'))
+            # optional day range, YYYY-MM-DD
+            since = request.args.get('since')
+            until = request.args.get('until')
+            since = datetime.date.fromisoformat(since) if since else None
+            until = datetime.date.fromisoformat(until) if until else None
+
+            cells = PostDensity.get_cells(south, west, north, east, zoom, since, until)
+            return jsonify(
+                {
+                    "success": True,
+                    "cells": cells
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
 
-            locations = Location.get_items_within_radius(latitude, longitude, radius)
+    @app.route("/api/search")
+    @read_replica
+    def search_items():
+        try:
+            terms = request.args.get('q', '')
+            lat, lng, radius = search_area(request.args)
+            cursor = request.args.get('cursor')
+
+            posts, next_cursor = Post.search(terms, lat, lng, radius, cursor)
             return jsonify(
                 {
                     "success": True,
-                    "results": locations
+                    "results": posts,
+                    "next_cursor": next_cursor
                 }
             ), 200
+        except (TypeError, ValueError):
+            # a malformed cursor or an incomplete search area
+            abort(400)
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
@@ -135,6 +509,16 @@ def create_app(test_config=None):
             "error": 500,
             "message": "server error"
         }), 500
+
+    @app.errorhandler(429)
+    @app.errorhandler(503)
+    def overloaded(error):
+        # turned away by admission control, see admission.py
+        return jsonify({
+            "success": False,
+            "error": error.code,
+            "message": error.description
+        }), error.code, {'Retry-After': str(error.retry_after or 1)}
         
             
     @app.route('/about')
@@ -181,7 +565,7 @@ def create_app(test_config=None):
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.get_by_id(user_id)
+        return User.get_cached(user_id)
 
     @app.route("/login", methods=['GET', 'POST'])
     def login():
@@ -209,15 +593,36 @@ def create_app(test_config=None):
     
     @app.route('/')
     @app.route('/public')
+    @read_replica
     def public():
-        posts = Post.query.order_by(Post.date_posted.desc())
-        return render_template("public.html", user=current_user, posts=posts)
+        cursor = request.args.get('cursor')
+        # the data version changes with every write in any worker, so a page
+        # cached before the latest post is never served again
+        key = ('public', data_version(), cursor)
+        feed = feed_cache.get(key)
+        if feed is None:
+            try:
+                posts, next_cursor = Post.get_feed(cursor)
+            except ValueError:
+                abort(400)
+            feed = render_template("public-feed.html", posts=posts, next_cursor=next_cursor)
+            feed_cache.set(key, feed)
+        return render_template("public.html", user=current_user, feed=feed)
 
 
     @app.route('/create', methods=['GET', 'POST'])
     @login_required
     def create():
-        notes = Post.query.order_by(Post.date_posted.desc()).filter_by(user_id=current_user.id)
+        cursor = request.args.get('cursor')
+        key = ('create', data_version(), current_user.id, cursor)
+        feed = feed_cache.get(key)
+        if feed is None:
+            try:
+                notes, next_cursor = Post.get_feed(cursor, user_id=current_user.id)
+            except ValueError:
+                abort(400)
+            feed = render_template("create-feed.html", notes=notes, next_cursor=next_cursor)
+            feed_cache.set(key, feed)
         if request.method == 'POST': 
             post = request.form.get('post')#Gets the post from the HTML 
             session["post"] = post
@@ -229,7 +634,7 @@ def create_app(test_config=None):
             else:
                 return redirect(url_for('say_location', user=current_user))
 
-        return render_template("create.html", user=current_user, notes=notes)
+        return render_template("create.html", user=current_user, feed=feed)
 
    
     @app.route("/say-location", methods=['GET', 'POST'])
@@ -243,22 +648,16 @@ def create_app(test_config=None):
             longitude = float(form.coord_longitude.data)
             description = form.description.data
 
-            location = Location(
-                description=description,
-                geom=Location.point_representation(latitude=latitude, longitude=longitude)
-            )
-            location.user_id = current_user.id
-            location.insert()
-            
-            new_post = Post(
-                content=post, 
-                user_id=current_user.id, 
-                description=description,
-                geom=Location.point_representation(latitude=latitude, longitude=longitude)
-                )  #providing the schema for the note 
-            #db.session.add(new_post) #adding the note to the database 
-            #db.session.commit()
-            new_post.insert()
+            # the location (if new) and the post are written in one transaction
+            with UnitOfWork() as work:
+                location = Location.find_or_create(latitude, longitude, description, current_user.id, work)
+                work.add(Post(
+                    content=post, 
+                    user_id=current_user.id, 
+                    description=description,
+                    location=location,
+                    geom=Location.point_representation(latitude=latitude, longitude=longitude)
+                    ))  #providing the schema for the note 
         
             flash(f'Your entry gets published!', 'success')
             return redirect(url_for('create'))
@@ -279,9 +678,14 @@ def create_app(test_config=None):
             lng = float(form.coord_longitude.data)
             radius = float(form.radius.data)
 
-            diary = Post.get_items_within_radius(lat, lng, radius)
-            session["diary"] = diary
-            session["description"] = form.description.data
+            # only the search itself goes into the session cookie, the
+            # results are kept server side (see browse)
+            session["area"] = {
+                "lat": lat,
+                "lng": lng,
+                "radius": radius,
+                "description": form.description.data
+            }
             
             return redirect(url_for('browse'))
         
@@ -294,34 +698,83 @@ def create_app(test_config=None):
         
         
     @app.route("/browse", methods=['GET', 'POST'])
+    @read_replica
+    @expensive_query
     def browse():
-        diary = session["diary"]
-        description = session["description"]
+        area = session.get("area")
+        if area is None:
+            return redirect(url_for('select_area'))
+        cursor = request.args.get('cursor')
+
+        key = (query_id(area["lat"], area["lng"], area["radius"]), cursor)
+        page = area_results.get(key)
+        if page is None:
+            # areas stored in the session before the radius cap are checked too
+            check_radius(Post, area["lat"], area["lng"], area["radius"])
+            try:
+                page = Post.get_items_within_radius(
+                    area["lat"], area["lng"], area["radius"], cursor, limit=PagingConstants.PAGE_SIZE)
+            except ValueError:
+                abort(400)
+            area_results.set(key, page)
+        diary, next_cursor = page
         
-        return render_template("browse.html", user=current_user, diary=diary, description=description)
+        return render_template("browse.html", user=current_user, diary=diary, description=area["description"], next_cursor=next_cursor)
     
     
     @app.route('/detail', methods=['GET'])
+    @read_replica
     def detail():
-        location_id = float(request.args.get('id'))
-        item = Location.query.get(location_id)
-        geom1 = item.geom
-        
-        diary = Post.get_items_with_same_geom(geom1)
+        location_id = request.args.get('id', type=int)
+        item = Location.query.get_or_404(location_id)
+        cursor = request.args.get('cursor')
+        try:
+            diary, next_cursor = Post.get_items_at_location(item.id, cursor)
+        except ValueError:
+            abort(400)
 
         return render_template(
             'detail_geom.html',
             item=item,
             diary=diary,
+            next_cursor=next_cursor,
             user=current_user,
             map_key=os.getenv('GOOGLE_MAPS_API_KEY', 'GOOGLE_MAPS_API_KEY_WAS_NOT_SET?!')
         )
     
     
+    @app.route('/search', methods=['GET'])
+    @read_replica
+    def search():
+        terms = request.args.get('q', '').strip()
+        cursor = request.args.get('cursor')
+        diary, next_cursor = [], None
+        try:
+            lat, lng, radius = search_area(request.args)
+            if terms:
+                diary, next_cursor = Post.search(terms, lat, lng, radius, cursor)
+        except (TypeError, ValueError):
+            abort(400)
+
+        return render_template(
+            'search.html',
+            diary=diary,
+            terms=terms,
+            area={name: request.args[name] for name in ('lat', 'lng', 'radius')} if radius is not None else {},
+            next_cursor=next_cursor,
+            user=current_user
+        )
+
     @app.route('/daily', methods=['GET'])
+    @read_replica
     def daily():
         date = request.args.get('date')
-        diary = Post.query.all()
+        page = request.args.get('page', 1, type=int)
+        try:
+            day = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            abort(400)
+        diary = Post.get_items_posted_on(day, page)
     
         return render_template(
             'daily.html',
@@ -334,9 +787,11 @@ def create_app(test_config=None):
     
             
     @app.route('/namely', methods=['GET'])
+    @read_replica
     def namely():
         name = request.args.get('name')
-        diary = Post.query.all()
+        page = request.args.get('page', 1, type=int)
+        diary = Post.get_items_with_description(name, page)
         
         return render_template(
             'namely.html',
@@ -348,9 +803,15 @@ def create_app(test_config=None):
         
       
     @app.route('/timely', methods=['GET'])
+    @read_replica
     def timely():
         time = request.args.get('time')
-        diary = Post.query.all()
+        page = request.args.get('page', 1, type=int)
+        try:
+            time_of_day = datetime.datetime.strptime(time, '%H:%M:%S').time()
+        except (TypeError, ValueError):
+            abort(400)
+        diary = Post.get_items_posted_at(time_of_day, page)
         
         return render_template(
             'timely.html',
@@ -360,10 +821,6 @@ def create_app(test_config=None):
             map_key=os.getenv('GOOGLE_MAPS_API_KEY', 'GOOGLE_MAPS_API_KEY_WAS_NOT_SET?!')
         )
 
-    @app.template_filter('timeago')
-    def fromnow(date):
-        return timeago.format(date, datetime.datetime.now())
-
     
     return app
 
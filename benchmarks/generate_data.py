@@ -0,0 +1,144 @@
+"""
+Fills the database with synthetic users, locations and posts.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.generate_data \
+        --users 10000 --locations 200000 --posts 2000000 [--drop]
+
+Locations are scattered around a few Berlin neighbourhoods (the places of
+insert_sample_locations and some more), denser near their centers, so
+radius and bbox queries see realistic clustering. Every post is written at
+one of the locations, as say_location does. The same --seed produces the
+same data, so benchmark runs on different commits are comparable.
+"""
+import argparse
+import hashlib
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, text
+from app import app
+from models import db, db_drop_and_create_all, User, Location, Post, PostDensity, SpatialConstants
+
+
+# (name, latitude, longitude, spread in degrees, weight)
+KIEZE = [
+    ('Brandenburger Tor', 52.516247, 13.377711, 0.010, 3),
+    ('Schloss Charlottenburg', 52.520608, 13.295581, 0.012, 2),
+    ('Tempelhofer Feld', 52.473580, 13.405252, 0.012, 2),
+    ('Kreuzberg', 52.497000, 13.411000, 0.015, 4),
+    ('Prenzlauer Berg', 52.539000, 13.424000, 0.012, 4),
+    ('Neukoelln', 52.481000, 13.435000, 0.015, 3),
+    ('Friedrichshain', 52.515000, 13.454000, 0.012, 3),
+    ('Wedding', 52.550000, 13.360000, 0.015, 2),
+]
+
+KIEZ_WEIGHTS = [kiez[4] for kiez in KIEZE]
+
+WORDS = (
+    'kiez morning coffee bike rain sun spree park market neighbour bakery '
+    'train night music street wall garden dog river bridge quiet loud '
+    'summer winter friends market tram late early dinner walk'
+).split()
+
+
+def random_point(rng):
+    name, lat, lng, spread, _ = rng.choices(KIEZE, weights=KIEZ_WEIGHTS)[0]
+    return name, rng.gauss(lat, spread), rng.gauss(lng, spread * 1.6)
+
+
+def point_wkt(lat, lng):
+    return 'SRID=%d;POINT(%r %r)' % (SpatialConstants.SRID, lng, lat)
+
+
+def insert_chunked(table, rows, chunk_size):
+    """Insert rows (a generator) chunk by chunk, one transaction per chunk"""
+    chunk = []
+    count = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            db.session.execute(insert(table), chunk)
+            db.session.commit()
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(insert(table), chunk)
+        db.session.commit()
+        count += len(chunk)
+    return count
+
+
+def generate_users(rng, count):
+    password = hashlib.md5('password'.encode()).hexdigest()
+    for i in range(count):
+        yield {
+            'name': 'user%d' % i,
+            'email': 'user%d@bench.kdiary' % i,
+            'password': password,
+            'created_at': datetime(2022, 1, 1) + timedelta(minutes=i)
+        }
+
+
+def generate_locations(rng, count, user_ids):
+    for i in range(count):
+        name, lat, lng = random_point(rng)
+        yield {
+            'description': '%s %d' % (name, i),
+            'geom': point_wkt(lat, lng),
+            'user_id': rng.choice(user_ids)
+        }
+
+
+def generate_posts(rng, count, user_ids, locations):
+    start = datetime(2022, 1, 1)
+    span = 3 * 365 * 24 * 3600
+    for i in range(count):
+        location_id, description, wkt = rng.choice(locations)
+        yield {
+            'date_posted': start + timedelta(seconds=rng.randrange(span), microseconds=rng.randrange(10 ** 6)),
+            'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))),
+            'description': description,
+            'geom': wkt,
+            'user_id': rng.choice(user_ids),
+            'location_id': location_id
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--locations', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--drop', action='store_true', help='drop and re-create all tables first')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        if args.drop:
+            db_drop_and_create_all()
+
+        started = time.perf_counter()
+        insert_chunked(User.__table__, generate_users(rng, args.users), args.chunk_size)
+        user_ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+
+        insert_chunked(Location.__table__, generate_locations(rng, args.locations, user_ids), args.chunk_size)
+        locations = [
+            (id, description, point_wkt(lat, lng))
+            for id, description, lat, lng in db.session.query(
+                Location.id, Location.description, Location.latitude, Location.longitude
+                ).order_by(Location.id)
+        ]
+
+        insert_chunked(Post.__table__, generate_posts(rng, args.posts, user_ids, locations), args.chunk_size)
+        PostDensity.rebuild()
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+
+        print('%d users, %d locations, %d posts in %.1fs' % (
+            args.users, args.locations, args.posts, time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
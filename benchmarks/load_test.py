@@ -0,0 +1,201 @@
+"""
+Load test against a running KDiary server.
+
+    python -m benchmarks.load_test --base-url http://127.0.0.1:5000 \
+        --concurrency 16 --requests 2000 > results.json
+
+Drives /api/get_items_in_radius, /public, /detail and /select-area (form
+POST followed by the /browse redirect) one scenario after another, each
+with a fixed number of concurrent clients, and prints p50/p99 latency and
+throughput per scenario as JSON. Fill the database with
+benchmarks.generate_data first and keep --seed fixed to compare commits.
+Needs nothing but the standard library.
+
+All simulated clients come from one address, so they share one rate limit
+bucket (see admission.py). To measure the queries rather than 429s, start
+the server with the limits lifted, e.g.
+
+    SPATIAL_QUERY_RATE=100000 SPATIAL_QUERY_BURST=100000 \
+    SPATIAL_QUERY_CONCURRENCY=64 MAX_ESTIMATED_ROWS=10000000 gunicorn ...
+
+Answers turned away by admission control (429/503) are counted as
+'rejected' instead of errors, so a run with the default limits shows them.
+"""
+import argparse
+import http.cookiejar
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+# somewhere in Berlin, see benchmarks.generate_data
+CENTER = (52.51, 13.40)
+RADII = (200, 500, 1000, 2000, 5000)
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Client:
+    """One simulated user: its own cookies, so sessions work like in a browser"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def get(self, path, params=None):
+        url = self.base_url + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        with self.opener.open(url, timeout=30) as response:
+            return response.read()
+
+    def post(self, path, data):
+        body = urllib.parse.urlencode(data).encode()
+        with self.opener.open(self.base_url + path, body, timeout=30) as response:
+            return response.read()
+
+
+def random_point(rng):
+    return rng.gauss(CENTER[0], 0.03), rng.gauss(CENTER[1], 0.05)
+
+
+def radius_request(client, rng, context):
+    lat, lng = random_point(rng)
+    client.get('/api/get_items_in_radius', {'lat': lat, 'lng': lng, 'radius': rng.choice(RADII)})
+
+
+def public_request(client, rng, context):
+    client.get('/public')
+
+
+def detail_request(client, rng, context):
+    client.get('/detail', {'id': rng.choice(context['location_ids'])})
+
+
+def select_area_request(client, rng, context):
+    # the form is CSRF protected, so every search starts by loading it
+    token = CSRF_TOKEN.search(client.get('/select-area').decode()).group(1)
+    lat, lng = random_point(rng)
+    client.post('/select-area', {
+        'csrf_token': token,
+        'description': 'load test',
+        'radius': rng.choice(RADII),
+        'coord_latitude': lat,
+        'coord_longitude': lng
+    })
+
+
+SCENARIOS = {
+    'get_items_in_radius': radius_request,
+    'public': public_request,
+    'detail': detail_request,
+    'select_area': select_area_request,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_scenario(base_url, request, context, concurrency, total, seed):
+    latencies = []
+    errors = []
+    rejected = [0]
+    remaining = [total]
+    lock = threading.Lock()
+
+    def worker(number):
+        client = Client(base_url)
+        rng = random.Random(seed * 1000 + number)
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                request(client, rng, context)
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+            except urllib.error.HTTPError as e:
+                with lock:
+                    if e.code in (429, 503):
+                        rejected[0] += 1
+                    else:
+                        errors.append(repr(e))
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    milliseconds = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rejected': rejected[0],
+        'first_error': errors[0] if errors else None,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 1) if duration else None,
+        'p50_ms': milliseconds(percentile(latencies, 0.50)),
+        'p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'max_ms': milliseconds(latencies[-1] if latencies else None),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='run only these scenarios (repeatable)')
+    args = parser.parse_args()
+
+    # /detail needs existing location ids, take them from the API (nearest
+    # is bounded by k, so it is not refused however large the dataset is)
+    found = json.loads(Client(args.base_url).get(
+        '/api/nearest', {'lat': CENTER[0], 'lng': CENTER[1], 'k': 100}))
+    context = {'location_ids': [item['id'] for item in found['results']] or [1]}
+
+    results = {}
+    for name in args.scenario or sorted(SCENARIOS):
+        results[name] = run_scenario(
+            args.base_url, SCENARIOS[name], context, args.concurrency, args.requests, args.seed)
+
+    print(json.dumps({
+        'commit': git_commit(),
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'requests_per_scenario': args.requests,
+        'seed': args.seed,
+        'scenarios': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
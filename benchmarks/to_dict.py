@@ -0,0 +1,65 @@
+"""
+Micro-benchmark: serializing rows with to_dict().
+
+    python -m benchmarks.to_dict [rows]
+
+Compares the old to_dict(), which parsed the WKB of geom through Shapely
+twice per row, with the current one, which reads the ST_X/ST_Y values
+selected along with the row. No database is needed: rows are built in
+memory the way the ORM hands them out after a radius query.
+"""
+import random
+import sys
+import timeit
+from geoalchemy2.shape import from_shape, to_shape
+from shapely.geometry import Point
+from models import Location, SpatialConstants
+
+
+def make_rows(count):
+    rows = []
+    for i in range(count):
+        # around the center of Berlin
+        lat = 52.52 + random.uniform(-0.1, 0.1)
+        lng = 13.405 + random.uniform(-0.15, 0.15)
+        location = Location(
+            id=i,
+            description='location %d' % i,
+            geom=from_shape(Point(lng, lat), srid=SpatialConstants.SRID)
+        )
+        location.latitude = lat
+        location.longitude = lng
+        rows.append(location)
+    return rows
+
+
+def to_dict_with_shapely(location):
+    return {
+        'id': location.id,
+        'description': location.description,
+        'location': {
+            'lng': to_shape(location.geom).x,
+            'lat': to_shape(location.geom).y
+        }
+    }
+
+
+def best_of(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = make_rows(count)
+
+    before = best_of(lambda: [to_dict_with_shapely(l) for l in rows])
+    after = best_of(lambda: [l.to_dict() for l in rows])
+
+    print('%d rows' % count)
+    print('shapely decode per row: %8.1f ms' % (before * 1000))
+    print('selected ST_X/ST_Y:     %8.1f ms' % (after * 1000))
+    print('speedup:                %8.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+
+
+class CacheConstants:
+    # results of /select-area searches, one entry per page of a search
+    AREA_RESULTS_SIZE = 1024
+    AREA_RESULTS_TTL = 120
+    # logged in users, loaded on every request; other workers see changes
+    # to a user at the latest after USERS_TTL seconds
+    USERS_SIZE = 4096
+    USERS_TTL = 60
+    # rendered feed pages (/public, /create), keyed on the data version, so
+    # writes in any worker show up at once; the TTL only bounds memory
+    FEED_SIZE = 256
+    FEED_TTL = 30
+
+
+class LRUCache:
+    """Thread-safe in-process cache that holds at most max_size entries,
+    evicts the least recently used one first and forgets entries ttl seconds
+    after they were stored. Every worker process has its own.
+    hits and misses count the lookups that found / did not find an entry."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def query_id(*params):
+    """Return a short id for a query, the same for the same parameters"""
+    return hashlib.sha1(repr(params).encode()).hexdigest()[:12]
@@ -0,0 +1,162 @@
+import os
+import json
+import queue
+import secrets
+import select
+import threading
+import time
+import logging
+from sqlalchemy import text
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventConstants:
+    CHANNEL = 'kdiary_items'
+    # events waiting for a slow client before newer ones are dropped
+    QUEUE_SIZE = 1000
+    # seconds between keepalive comments on an idle stream; a closed stream
+    # is only noticed when something is written to it
+    KEEPALIVE = 5
+    # open streams per worker process. With gthread workers every stream holds
+    # one of the worker's threads, so keep this below GUNICORN_THREADS; with
+    # gevent workers (see gunicorn.conf.py) it can be much higher
+    MAX_STREAMS = int(os.getenv('MAX_STREAMS', 2))
+
+
+'''
+New posts and locations are announced with NOTIFY in the transaction that
+inserts them, so listeners only hear about committed rows. The payload is
+built in SQL from the stored row and has the shape of to_dict() plus a
+'type' ('post' or 'location'). Deletes are announced the same way, before
+the row goes, with the id and point only ('post_deleted', 'location_deleted').
+'''
+NOTIFY_SQL = {
+    'location': '''
+        SELECT pg_notify(:channel, json_build_object(
+            'type', 'location', 'id', id, 'description', description,
+            'location', json_build_object('lat', ST_Y(geom), 'lng', ST_X(geom)))::text)
+        FROM sample_locations WHERE id = ANY(:ids) AND geom IS NOT NULL
+    ''',
+    'post': '''
+        SELECT pg_notify(:channel, json_build_object(
+            'type', 'post', 'id', id, 'description', description,
+            'date_posted', date_posted, 'location_id', location_id,
+            'location', json_build_object('lat', ST_Y(geom), 'lng', ST_X(geom)))::text)
+        FROM post WHERE id = ANY(:ids) AND geom IS NOT NULL
+    ''',
+    'location_deleted': '''
+        SELECT pg_notify(:channel, json_build_object(
+            'type', 'location_deleted', 'id', id,
+            'location', json_build_object('lat', ST_Y(geom), 'lng', ST_X(geom)))::text)
+        FROM sample_locations WHERE id = ANY(:ids) AND geom IS NOT NULL
+    ''',
+    'post_deleted': '''
+        SELECT pg_notify(:channel, json_build_object(
+            'type', 'post_deleted', 'id', id,
+            'location', json_build_object('lat', ST_Y(geom), 'lng', ST_X(geom)))::text)
+        FROM post WHERE id = ANY(:ids) AND geom IS NOT NULL
+    '''
+}
+
+def notify_inserted(session, kind, ids):
+    """Announce new rows ('post' or 'location') when the current transaction commits"""
+    session.execute(text(NOTIFY_SQL[kind]), {'channel': EventConstants.CHANNEL, 'ids': list(ids)})
+
+def notify_deleted(session, kind, ids):
+    """Announce rows ('post' or 'location') deleted in the current transaction, call before deleting them"""
+    session.execute(text(NOTIFY_SQL[kind + '_deleted']), {'channel': EventConstants.CHANNEL, 'ids': list(ids)})
+
+
+class Subscription:
+    """Events inside one bounding box, waiting to be sent to one client"""
+
+    def __init__(self, south, west, north, east):
+        self.id = secrets.token_urlsafe(16)
+        self.box = (south, west, north, east)
+        self.queue = queue.Queue(EventConstants.QUEUE_SIZE)
+
+    def contains(self, lat, lng):
+        south, west, north, east = self.box
+        if not south <= lat <= north:
+            return False
+        if west <= east:
+            return west <= lng <= east
+        # the box crosses the antimeridian
+        return lng >= west or lng <= east
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+
+class ItemEvents:
+    """Fans NOTIFY events out to the subscriptions of this worker. One thread
+    per worker LISTENs on its own connection, started with the first
+    subscription (so nothing runs in a preloading gunicorn master)."""
+
+    def __init__(self):
+        self._subscriptions = {}  # id -> Subscription
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, app, south, west, north, east, limit=None):
+        """Return a new subscription, or None if limit subscriptions with a
+        limit are open already (client streams; the spatial index has none)"""
+        subscription = Subscription(south, west, north, east)
+        subscription.limited = limit is not None
+        with self._lock:
+            if limit is not None and sum(s.limited for s in self._subscriptions.values()) >= limit:
+                return None
+            self._subscriptions[subscription.id] = subscription
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, args=(app,), daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.pop(subscription.id, None)
+
+    def publish(self, item):
+        location = item.get('location') or {}
+        if location.get('lat') is None or location.get('lng') is None:
+            return
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+        for subscription in subscriptions:
+            if subscription.contains(location.get('lat'), location.get('lng')):
+                try:
+                    subscription.queue.put_nowait(item)
+                except queue.Full:
+                    pass
+
+    def _listen(self, app):
+        from models import db
+        while True:
+            dbapi_connection = None
+            try:
+                with app.app_context():
+                    # a connection of its own, taken out of the pool for good
+                    connection = db.engine.raw_connection()
+                    connection.detach()
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute('LISTEN %s' % EventConstants.CHANNEL)
+                while True:
+                    if select.select([dbapi_connection], [], [], EventConstants.KEEPALIVE) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        self.publish(json.loads(dbapi_connection.notifies.pop(0).payload))
+            except Exception:
+                logger.exception('listening for %s failed, reconnecting', EventConstants.CHANNEL)
+                if dbapi_connection is not None:
+                    try:
+                        dbapi_connection.close()
+                    except Exception:
+                        pass
+                time.sleep(5)
+
+
+item_events = ItemEvents()
@@ -0,0 +1,62 @@
+"""
+Checks that radius queries are answered from the GiST index on geog.
+
+    DATABASE_URL=postgresql://... python explain_radius.py
+
+Runs EXPLAIN for the Location and Post radius queries against the configured
+PostGIS database and exits with status 1 if either can only be answered by a
+sequential scan. On near-empty tables the planner prefers a seq scan anyway,
+so a plan without an index is re-checked with enable_seqscan off.
+"""
+import sys
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from app import app
+from models import db, Location, Post, within_radius_query
+
+
+class explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain, 'postgresql')
+def pg_explain(element, compiler, **kw):
+    return 'EXPLAIN ' + compiler.process(element.statement, **kw)
+
+
+def query_plan(model, lat, lng, radius):
+    query, distance = within_radius_query(model, lat, lng, radius)
+    statement = query.order_by(distance, model.id).limit(100).statement
+    return '\n'.join(row[0] for row in db.session.execute(explain(statement)))
+
+
+def uses_index(plan):
+    return 'Index Scan' in plan or 'Index Only Scan' in plan
+
+
+def main():
+    # Brandenburger Tor, 2km
+    lat, lng, radius = 52.516247, 13.377711, 2000
+    failed = False
+
+    with app.app_context():
+        for model in (Location, Post):
+            plan = query_plan(model, lat, lng, radius)
+            if not uses_index(plan):
+                db.session.execute(text('SET LOCAL enable_seqscan = off'))
+                plan = query_plan(model, lat, lng, radius)
+                db.session.rollback()
+
+            status = 'index scan' if uses_index(plan) else 'SEQ SCAN'
+            print('%s: %s\n%s\n' % (model.__tablename__, status, plan))
+            failed = failed or not uses_index(plan)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
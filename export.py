@@ -0,0 +1,61 @@
+import json
+from datetime import datetime
+
+
+class ExportConstants:
+    # rows per round trip of the server-side cursor
+    CHUNK_SIZE = 1000
+    MIMETYPES = {
+        'ndjson': 'application/x-ndjson',
+        'geojson': 'application/geo+json'
+    }
+
+
+def export_filters(args):
+    """Return the filters of Post.export given as query arguments (or CLI
+    options): south, west, north and east for a bounding box, lat, lng and
+    radius (in meters) for a circle, since and until (ISO 8601, until is
+    exclusive) for a date range; any combination, none exports everything.
+    Raise ValueError if a filter is incomplete or malformed."""
+    filters = {}
+    bbox = [args.get(name) for name in ('south', 'west', 'north', 'east')]
+    if any(value is not None for value in bbox):
+        filters['bbox'] = tuple(float(value) for value in bbox)
+    circle = [args.get(name) for name in ('lat', 'lng', 'radius')]
+    if any(value is not None for value in circle):
+        filters['lat'], filters['lng'], filters['radius'] = (float(value) for value in circle)
+    for name in ('since', 'until'):
+        if args.get(name):
+            filters[name] = datetime.fromisoformat(args.get(name))
+    return filters
+
+
+def to_ndjson(posts):
+    """Yield one JSON line per post"""
+    for post in posts:
+        yield json.dumps(post) + '\n'
+
+
+def to_geojson(posts):
+    """Yield a GeoJSON FeatureCollection piece by piece, one feature per post"""
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = '\n'
+    for post in posts:
+        location = post.pop('location')
+        geometry = None
+        if location['lat'] is not None:
+            geometry = {'type': 'Point', 'coordinates': [location['lng'], location['lat']]}
+        yield separator + json.dumps({
+            'type': 'Feature',
+            'id': post['id'],
+            'geometry': geometry,
+            'properties': post
+        })
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+FORMATS = {
+    'ndjson': to_ndjson,
+    'geojson': to_geojson
+}
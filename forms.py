@@ -1,6 +1,7 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, HiddenField, PasswordField, BooleanField, IntegerField
-from wtforms.validators import DataRequired, Length, Email, EqualTo
+from wtforms.validators import DataRequired, Length, Email, EqualTo, NumberRange
+from admission import AdmissionConstants
 
 
 class NewLocationForm(FlaskForm):
@@ -20,7 +21,7 @@ class SelectAreaForm(FlaskForm):
                            validators=[DataRequired(), Length(min=1, max=80)])
     lookup_address = StringField('Name of a street, place or building')
     radius = IntegerField('Search radius (in meter)', 
-                          validators=[DataRequired()])
+                          validators=[DataRequired(), NumberRange(min=1, max=AdmissionConstants.MAX_RADIUS)])
 
     coord_latitude = HiddenField('Latitude',validators=[DataRequired()])
 
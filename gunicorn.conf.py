@@ -0,0 +1,51 @@
+# Production settings for gunicorn:
+#
+#     APP_MODE=production SECRET_KEY=... DATABASE_URL=... gunicorn -c gunicorn.conf.py app:app
+#
+# Every worker is a separate process with its own connection pool and its
+# own in-process caches (users, feed pages, area results). Requests mostly
+# wait on PostgreSQL, so a few threads per worker keep the CPU busy; size
+# workers x threads together with the database pool (pool size per worker
+# times workers must stay below max_connections).
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:%s' % os.getenv('PORT', '8000'))
+
+# one to two workers per core, a handful of threads each
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2))
+# the app splits per-client rate limits over the workers (see admission.py)
+os.environ['WEB_CONCURRENCY'] = str(workers)
+# Every open /api/stream (live map updates) holds a thread of a gthread
+# worker, so each worker only allows MAX_STREAMS of them (see events.py).
+# For many concurrent map viewers run gevent workers instead, where a
+# stream costs a greenlet: pip install gevent psycogreen, then start with
+# GUNICORN_WORKER_CLASS=gevent MAX_STREAMS=500 (post_fork below makes
+# psycopg2 cooperative).
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# import the app once in the master and fork it, workers start faster and
+# share the loaded code; post_fork makes sure no connection is shared
+preload_app = True
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# recycle workers now and then to bound memory growth of the caches
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    from app import app
+    from models import dispose_engines
+    from spatial_index import spatial_index
+    dispose_engines(app)
+    # load the in-memory spatial index now rather than on the first request
+    spatial_index.start()
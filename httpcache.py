@@ -0,0 +1,157 @@
+import os
+import json
+import gzip
+import shutil
+import hashlib
+import mimetypes
+from functools import wraps
+from flask import request, make_response, send_from_directory, url_for
+from models import data_version
+from spatial_index import spatial_index
+
+try:
+    import brotli
+except ImportError:
+    # optional, without it responses and assets are gzipped only
+    brotli = None
+
+
+class HttpCacheConstants:
+    # the build-assets CLI command writes fingerprinted copies here, under static/
+    ASSETS_FOLDER = 'dist'
+    MANIFEST = 'manifest.json'
+    # fingerprinted assets never change, browsers may keep them for a year
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+    # responses smaller than this are sent as they are
+    COMPRESS_MIN_SIZE = 500
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+    # only API data is compressed on the fly: HTML pages carry CSRF tokens
+    # next to reflected input, which compression would expose (BREACH)
+    COMPRESSED_RESPONSES = {'application/json', 'application/geo+json'}
+    # asset types precompressed by build_assets
+    COMPRESSED_ASSETS = {
+        'application/javascript', 'text/javascript', 'text/css', 'image/svg+xml', 'application/json'
+    }
+
+
+def versioned(view):
+    """Conditional GET for views whose response only depends on their URL and
+    the map data: the ETag is the data version (plus the generation of the
+    spatial index if it answers the query), an If-None-Match with the current
+    one gets a 304 without running the view. Clients revalidate every time."""
+    @wraps(view)
+    def conditional(*args, **kwargs):
+        etag = 'v%d' % data_version()
+        if spatial_index.ready():
+            etag += '.%d' % spatial_index.generation
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+    return conditional
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=HttpCacheConstants.BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=HttpCacheConstants.GZIP_LEVEL)
+
+def accepted_encoding():
+    """'br' or 'gzip' if the client takes it (br only with brotli installed), else None"""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def build_assets(static_folder):
+    """Copy every file of static_folder to static_folder/dist under a name
+    with its content hash (map.js -> map.3f2a1b0c9d8e.js), next to gzip and
+    brotli compressed copies of text files, and write the manifest of names.
+    Return the manifest."""
+    build_folder = os.path.join(static_folder, HttpCacheConstants.ASSETS_FOLDER)
+    if os.path.isdir(build_folder):
+        shutil.rmtree(build_folder)
+    os.makedirs(build_folder)
+    manifest = {}
+    for name in sorted(os.listdir(static_folder)):
+        path = os.path.join(static_folder, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        stem, extension = os.path.splitext(name)
+        built_name = '%s.%s%s' % (stem, hashlib.sha256(data).hexdigest()[:12], extension)
+        built_path = os.path.join(build_folder, built_name)
+        with open(built_path, 'wb') as f:
+            f.write(data)
+        if mimetypes.guess_type(name)[0] in HttpCacheConstants.COMPRESSED_ASSETS:
+            with open(built_path + '.gz', 'wb') as f:
+                f.write(compress(data, 'gzip'))
+            if brotli is not None:
+                # built once, worth the slowest setting
+                with open(built_path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+        manifest[name] = built_name
+    with open(os.path.join(build_folder, HttpCacheConstants.MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def init_http_cache(app):
+    """Compress JSON responses (brotli or gzip, whatever the client takes) and
+    serve the assets built by build_assets from /assets with long-lived
+    caching, precompressed. Templates link assets with asset_url('map.js'),
+    which falls back to /static until the assets are built."""
+    build_folder = os.path.join(app.static_folder, HttpCacheConstants.ASSETS_FOLDER)
+    try:
+        with open(os.path.join(build_folder, HttpCacheConstants.MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+
+    @app.context_processor
+    def asset_urls():
+        def asset_url(filename):
+            if filename in manifest:
+                return url_for('asset', filename=manifest[filename])
+            return url_for('static', filename=filename)
+        return {'asset_url': asset_url}
+
+    @app.route('/assets/<path:filename>')
+    def asset(filename):
+        encoding = accepted_encoding()
+        suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding)
+        if suffix and os.path.isfile(os.path.join(build_folder, filename + suffix)):
+            response = send_from_directory(build_folder, filename + suffix,
+                mimetype=mimetypes.guess_type(filename)[0], max_age=HttpCacheConstants.ASSETS_MAX_AGE)
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = send_from_directory(build_folder, filename, max_age=HttpCacheConstants.ASSETS_MAX_AGE)
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % HttpCacheConstants.ASSETS_MAX_AGE
+        return response
+
+    @app.after_request
+    def compress_response(response):
+        # streamed responses (/api/stream, /api/export) and files go out as they are
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in HttpCacheConstants.COMPRESSED_RESPONSES):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = accepted_encoding()
+        data = response.get_data()
+        if encoding is None or len(data) < HttpCacheConstants.COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
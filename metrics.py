@@ -0,0 +1,123 @@
+import os
+import time
+import logging
+import threading
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsConstants:
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+    # statements slower than this are logged with their SQL
+    SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', 0.25))
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense, one series per label set.
+    Observing costs a loop over a dozen buckets under a lock."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}  # labels -> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(labels + (('le', repr(float(bound))),)), count))
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(labels + (('le', '+Inf'),)), values[-1]))
+            lines.append('%s_sum%s %r' % (self.name, format_labels(labels), values[-2]))
+            lines.append('%s_count%s %d' % (self.name, format_labels(labels), values[-1]))
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+
+request_latency = Histogram(
+    'kdiary_request_duration_seconds', 'Time spent handling a request.', MetricsConstants.LATENCY_BUCKETS)
+request_statements = Histogram(
+    'kdiary_request_sql_statements', 'SQL statements executed per request.', MetricsConstants.STATEMENT_BUCKETS)
+request_sql_time = Histogram(
+    'kdiary_request_sql_duration_seconds', 'Time spent in SQL per request.', MetricsConstants.LATENCY_BUCKETS)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_time += elapsed
+    if elapsed >= MetricsConstants.SLOW_QUERY_SECONDS:
+        logger.warning('slow query (%.3fs): %s', elapsed, ' '.join(statement.split())[:1000])
+
+
+def init_metrics(app, caches=None):
+    """Time every request and count its SQL statements (engine events on all
+    engines), log slow statements and serve everything on /metrics in the
+    Prometheus text format. caches maps a name to an LRUCache whose hit and
+    miss counters are exported as well. Numbers are per worker process."""
+    caches = caches or {}
+
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_start = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_time = 0.0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_start' not in g:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        request_latency.observe(
+            (('endpoint', endpoint), ('method', request.method), ('status', response.status_code)),
+            time.perf_counter() - g.request_start)
+        request_statements.observe((('endpoint', endpoint),), g.sql_statements)
+        request_sql_time.observe((('endpoint', endpoint),), g.sql_time)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        lines = []
+        for histogram in (request_latency, request_statements, request_sql_time):
+            lines.extend(histogram.render())
+        for kind in ('hits', 'misses'):
+            lines.append('# TYPE kdiary_cache_%s_total counter' % kind)
+            for name, cache in sorted(caches.items()):
+                lines.append('kdiary_cache_%s_total{cache="%s"} %d' % (kind, name, getattr(cache, kind)))
+        lines.append('# TYPE kdiary_cache_entries gauge')
+        for name, cache in sorted(caches.items()):
+            lines.append('kdiary_cache_entries{cache="%s"} %d' % (name, len(cache)))
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,8 @@
+-- Indexes behind /daily, /namely, /timely and the keyset-paginated feed.
+-- New databases get these from db.create_all(); run this once on databases
+-- created before them:  psql "$DATABASE_URL" -f migrations/001_post_indexes.sql
+
+CREATE INDEX IF NOT EXISTS ix_post_date_posted_id ON post (date_posted, id);
+CREATE INDEX IF NOT EXISTS ix_post_description ON post (description);
+CREATE INDEX IF NOT EXISTS ix_post_time_of_day
+    ON post (CAST(date_trunc('second', date_posted) AS TIME));
@@ -0,0 +1,24 @@
+-- Stored geography copies of geom with GiST indexes, used by the radius
+-- queries (ST_DWithin / ST_Distance in meters). A cast in the query cannot
+-- use the GiST index on geom, a stored column with its own index can.
+--   psql "$DATABASE_URL" -f migrations/002_geography_columns.sql
+-- Adding a stored generated column rewrites the table, run it off-peak.
+
+BEGIN;
+
+ALTER TABLE sample_locations
+    ADD COLUMN IF NOT EXISTS geog geography(POINT, 4326)
+    GENERATED ALWAYS AS (geom::geography) STORED;
+CREATE INDEX IF NOT EXISTS idx_sample_locations_geog
+    ON sample_locations USING GIST (geog);
+
+ALTER TABLE post
+    ADD COLUMN IF NOT EXISTS geog geography(POINT, 4326)
+    GENERATED ALWAYS AS (geom::geography) STORED;
+CREATE INDEX IF NOT EXISTS idx_post_geog
+    ON post USING GIST (geog);
+
+COMMIT;
+
+ANALYZE sample_locations;
+ANALYZE post;
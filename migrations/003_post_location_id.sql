@@ -0,0 +1,11 @@
+-- Posts reference the sample location they were written at; /detail lists
+-- a place's posts through this key instead of comparing geometries.
+--   psql "$DATABASE_URL" -f migrations/003_post_location_id.sql
+-- then link the existing posts in batches:
+--   FLASK_APP=app flask link-posts
+
+ALTER TABLE post
+    ADD COLUMN IF NOT EXISTS location_id integer
+    REFERENCES sample_locations (id) ON DELETE SET NULL;
+CREATE INDEX IF NOT EXISTS ix_post_location_id_date_posted_id
+    ON post (location_id, date_posted, id);
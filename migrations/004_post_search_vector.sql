@@ -0,0 +1,10 @@
+-- Full-text search over posts (/search, /api/search): a stored tsvector of
+-- description and content with a GIN index.
+--   psql "$DATABASE_URL" -f migrations/004_post_search_vector.sql
+-- Adding a stored generated column rewrites the table, run it off-peak.
+
+ALTER TABLE post
+    ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(description, '') || ' ' || content)) STORED;
+CREATE INDEX IF NOT EXISTS ix_post_search_vector
+    ON post USING GIN (search_vector);
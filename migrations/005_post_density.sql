@@ -0,0 +1,12 @@
+-- Post counts per grid cell and day for /api/density. Fill it afterwards:
+--   psql "$DATABASE_URL" -f migrations/005_post_density.sql
+--   FLASK_APP=app flask rebuild-density
+
+CREATE TABLE IF NOT EXISTS post_density (
+    zoom smallint NOT NULL,
+    cell_x integer NOT NULL,
+    cell_y integer NOT NULL,
+    day date NOT NULL,
+    count integer NOT NULL,
+    PRIMARY KEY (zoom, cell_x, cell_y, day)
+);
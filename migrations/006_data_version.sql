@@ -0,0 +1,10 @@
+-- Version of the map data, bumped by the app in every write transaction and
+-- used as the ETag of the map APIs:
+--   psql "$DATABASE_URL" -f migrations/006_data_version.sql
+
+CREATE TABLE IF NOT EXISTS data_version (
+    id integer PRIMARY KEY,
+    version bigint NOT NULL DEFAULT 0
+);
+
+INSERT INTO data_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
@@ -1,34 +1,201 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import queue
+import atexit
+import logging
+import threading
+import time
+from sqlalchemy import Column, String, Integer, BigInteger, Float, Time, Computed, create_engine, func, tuple_, or_, insert, text
+from sqlalchemy.exc import SQLAlchemyError
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from functools import wraps
 from geoalchemy2.types import Geometry
 from shapely.geometry import Point
-from geoalchemy2.shape import to_shape
 from geoalchemy2.elements import WKTElement
-from geoalchemy2.functions import ST_DWithin
+from geoalchemy2.functions import ST_DWithin, ST_Distance
 from geoalchemy2.types import Geography
 from sqlalchemy.sql.expression import cast
-from geoalchemy2.shape import from_shape
-from datetime import datetime
+from sqlalchemy.orm import column_property, deferred, make_transient_to_detached
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from geoalchemy2.shape import from_shape, to_shape
+from datetime import datetime, timedelta
 from flask_login import UserMixin
 import hashlib
+from cache import LRUCache, CacheConstants
+from events import notify_inserted, notify_deleted
+from spatial_index import spatial_index, SpatialIndexConstants
 
 
-db = SQLAlchemy()
+'''
+Sessions that send the reads of read-only views to a replica.
+Views decorated with @read_replica run their queries on the 'replica' bind
+(DATABASE_REPLICA_URL) when one is configured. Only SELECTs go there:
+flushes, any other statement (INSERT, UPDATE, DELETE, text() SQL such as the
+data version bump or NOTIFY) and every other view stay on the primary.
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing and getattr(clause, 'is_select', False)
+                and uses_replica(self.app)):
+            return get_state(self.app).db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+def uses_replica(app):
+    return (has_request_context() and g.get('read_replica', False)
+            and 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {}))
+
+def read_replica(view):
+    """Mark a view as read-only, so its queries may go to the replica"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app):
     binds a flask application and a SQLAlchemy service
+    connection pool and timeouts are configured with
+    DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT (seconds),
+    DATABASE_POOL_RECYCLE (seconds), DATABASE_POOL_PRE_PING (0/1) and
+    DATABASE_STATEMENT_TIMEOUT (milliseconds, 0 = none); they apply to the
+    primary and to the optional DATABASE_REPLICA_URL alike
 '''
 def setup_db(app):
     database_path = os.getenv('DATABASE_URL', 'DATABASE_URL_WAS_NOT_SET?!')
 
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+
+    replica_path = os.getenv('DATABASE_REPLICA_URL')
+    if replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {'replica': replica_path}
 
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
 
+def engine_options():
+    options = {
+        'pool_size': int(os.getenv('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DATABASE_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('DATABASE_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.getenv('DATABASE_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DATABASE_POOL_PRE_PING', '1') == '1',
+    }
+    statement_timeout = int(os.getenv('DATABASE_STATEMENT_TIMEOUT', 0))
+    if statement_timeout:
+        options['connect_args'] = {'options': '-c statement_timeout=%d' % statement_timeout}
+    return options
+
+'''
+dispose_engines(app):
+    drops the pooled connections a forked worker inherited from its parent,
+    without closing them (they belong to the parent), so that every worker
+    opens its own connections
+'''
+def dispose_engines(app):
+    with app.app_context():
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            db.get_engine(app, bind=bind).dispose(close=False)
+
+'''
+Data version: a one-row counter bumped in every transaction that changes
+locations or posts, so the map APIs can answer If-None-Match without running
+their query (see httpcache.versioned). The bump commits together with the
+data, so every reader, on the primary or a replica, sees both or neither.
+Concurrent writers queue on the row lock until the first one commits.
+'''
+class DataVersion(db.Model):
+    __tablename__ = 'data_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+BUMP_DATA_VERSION_SQL = '''
+    INSERT INTO data_version (id, version) VALUES (1, 1)
+    ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1
+'''
+
+def data_version():
+    version = db.session.execute(text('SELECT version FROM data_version WHERE id = 1')).scalar()
+    return version or 0
+
+def bump_data_version():
+    """Count a change in the current transaction, call it before the commit"""
+    db.session.execute(text(BUMP_DATA_VERSION_SQL))
+
+'''
+UnitOfWork:
+    stages new locations and posts and writes them in one transaction, with
+    one flush and one commit, together with what every insert brings along
+    (post density counts, NOTIFY of new items, the data version bump).
+    Used as a context manager it commits on success and rolls back if the
+    block raises:
+
+        with UnitOfWork() as work:
+            location = Location.find_or_create(lat, lng, description, user_id, work)
+            work.add(Post(content=content, location=location, ...))
+'''
+class UnitOfWork:
+    def __init__(self):
+        self.locations = []
+        self.posts = []
+
+    def add(self, item):
+        db.session.add(item)
+        if isinstance(item, Post):
+            self.posts.append(item)
+        elif isinstance(item, Location):
+            self.locations.append(item)
+        return item
+
+    def flush(self):
+        """Send the staged rows to the database (assigning their ids) without committing"""
+        db.session.flush()
+
+    def commit(self):
+        db.session.flush()
+        if self.locations:
+            notify_inserted(db.session, 'location', [location.id for location in self.locations])
+        if self.posts:
+            post_ids = [post.id for post in self.posts]
+            PostDensity.add_posts(post_ids)
+            notify_inserted(db.session, 'post', post_ids)
+        # points read before the commit expires the objects
+        locations, posts = [], []
+        if SpatialIndexConstants.ENABLED:
+            locations = [(l.id, l.description, to_shape(l.geom)) for l in self.locations if l.geom is not None]
+            posts = [(p.id, to_shape(p.geom)) for p in self.posts if p.geom is not None]
+        bump_data_version()
+        db.session.commit()
+        for id, description, point in locations:
+            spatial_index.add_location(id, description, point.y, point.x)
+        for id, point in posts:
+            spatial_index.add_post(id, point.y, point.x)
+        self.locations, self.posts = [], []
+
+    def rollback(self):
+        db.session.rollback()
+        self.locations, self.posts = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
 '''
     drops the database tables and starts fresh
     can be used to initialize a clean database
@@ -84,12 +251,203 @@ def insert_sample_locations():
 
 class SpatialConstants:
     SRID = 4326
+
+'''
+Radius queries measure in meters, so they need geography. Casting geom in
+the query hides it from the GiST index on geom; instead each spatial table
+keeps a stored geography copy of geom (with its own GiST index) that
+ST_DWithin/ST_Distance run against. See migrations/ for existing databases.
+It is only used in SQL, so it is deferred: loading a row does not fetch it.
+'''
+def geography_column():
+    return deferred(Column(
+        Geography(geometry_type='POINT', srid=SpatialConstants.SRID),
+        Computed('geom::geography', persisted=True)))
+
+'''
+Coordinates are selected as ST_Y(geom)/ST_X(geom) along with every row,
+so serializing a row reads two floats instead of parsing the WKB of geom
+through Shapely.
+'''
+def latitude_property(geom):
+    return column_property(func.ST_Y(geom))
+
+def longitude_property(geom):
+    return column_property(func.ST_X(geom))
+
+class ClusterConstants:
+    # up to this zoom level the map shows clusters instead of single markers
+    MAX_ZOOM = 12
+    # a 256px map tile is split into CELLS_PER_TILE x CELLS_PER_TILE cells
+    CELLS_PER_TILE = 4
+
+class SearchConstants:
+    # posts are in several languages, so words are indexed as written (no stemming)
+    TEXT_SEARCH_CONFIG = 'simple'
+
+class DensityConstants:
+    # zoom levels post_density keeps counts for, every post adds one row per level
+    ZOOM_LEVELS = tuple(range(6, 17))
+
+class PagingConstants:
+    PAGE_SIZE = 20
+    API_PAGE_SIZE = 100
+    BBOX_LIMIT = 500
+
+
+'''
+Keyset pagination helpers.
+A cursor is the sort key of the last row of a page plus its id, e.g.
+"2022-08-01T10:15:00.123456_42" for the feed or "153.2_42" for radius
+queries, so the next page is a plain index range scan instead of an OFFSET.
+'''
+def encode_cursor(key, id):
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    return '%s_%s' % (key, id)
+
+def decode_cursor(cursor, parse_key):
+    """Return (key, id) for a cursor, raise ValueError if it is malformed"""
+    key, _, id = cursor.rpartition('_')
+    if not key:
+        raise ValueError('invalid cursor: %r' % cursor)
+    return parse_key(key), int(id)
+
+def paginate_by_date(query, model, cursor=None, limit=PagingConstants.PAGE_SIZE):
+    """Return (items, next_cursor) of a query ordered newest first"""
+    if cursor:
+        last_date, last_id = decode_cursor(cursor, datetime.fromisoformat)
+        query = query.filter(tuple_(model.date_posted, model.id) < tuple_(last_date, last_id))
+    items = query.order_by(model.date_posted.desc(), model.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].date_posted, items[-1].id)
+    return items, next_cursor
+
+def radius_filter(model, lat, lng, radius):
+    """Return a filter for rows within radius (in meters) and the distance
+    expression, both on the indexed geog column"""
+    center = cast(from_shape(Point(lng, lat), srid=SpatialConstants.SRID), Geography)
+    return ST_DWithin(model.geog, center, radius), ST_Distance(model.geog, center)
+
+def nearest_rows(model, lat, lng, k):
+    """Return the k rows closest to lat/lng as (row, distance in meters),
+    nearest first. ORDER BY geog <-> center is answered by walking the GiST
+    index on geog, so the cost depends on k, not on how dense the area is.
+    <-> measures on a sphere, the few rows found are re-sorted by the exact
+    (spheroid) distance."""
+    center = cast(from_shape(Point(lng, lat), srid=SpatialConstants.SRID), Geography)
+    rows = db.session.query(model, ST_Distance(model.geog, center)).filter(
+        model.geog.isnot(None)
+        ).order_by(model.geog.op('<->')(center)).limit(k).all()
+    return sorted(rows, key=lambda row: (row[1], row[0].id))
+
+def within_radius_query(model, lat, lng, radius):
+    """Return a (model, distance) query of rows within radius (in meters) and
+    the distance expression"""
+    within, distance = radius_filter(model, lat, lng, radius)
+    return db.session.query(model, distance).filter(within), distance
+
+def bbox_filter(model, south, west, north, east):
+    """Return a filter for rows inside a lat/lng bounding box (geom && envelope,
+    answered by the GiST index on geom). A box crossing the antimeridian has
+    west > east and is split in two."""
+    def envelope(west, east):
+        return model.geom.intersects(
+            func.ST_MakeEnvelope(west, south, east, north, SpatialConstants.SRID))
+    if west <= east:
+        return envelope(west, east)
+    return or_(envelope(west, 180), envelope(-180, east))
+
+def diff_in_bbox(model, south, west, north, east, known_ids, limit=PagingConstants.BBOX_LIMIT):
+    """Compare the rows inside a bounding box with the ids a client already has.
+    Return (added, removed_ids, truncated): full rows only for ids the client
+    does not know yet, ids it should drop, and whether the box held more than
+    limit rows (the lowest ids are kept so the subset is stable across pans)."""
+    ids = [id for id, in db.session.query(model.id).filter(
+        bbox_filter(model, south, west, north, east)
+        ).order_by(model.id).limit(limit + 1)]
+    truncated = len(ids) > limit
+    in_view = set(ids[:limit])
+    added_ids = in_view - known_ids
+    added = model.query.filter(model.id.in_(added_ids)).all() if added_ids else []
+    return added, sorted(known_ids - in_view), truncated
+
+def grid_cell_size(zoom):
+    """Edge of a grid cell in degrees at a zoom level: a 256px map tile is
+    split into CELLS_PER_TILE x CELLS_PER_TILE cells, aligned to lng/lat 0/0"""
+    return 360.0 / (2 ** zoom) / ClusterConstants.CELLS_PER_TILE
+
+def clusters_in_bbox(model, south, west, north, east, zoom):
+    """Group the rows inside a bounding box into grid cells sized for the zoom
+    level and return one dict per cell with the count and the centroid.
+    Cells are aligned to lng/lat 0/0, so a cell is the same on every pan."""
+    cell_size = grid_cell_size(zoom)
+    lng = func.ST_X(model.geom)
+    lat = func.ST_Y(model.geom)
+    cell_x = func.floor(lng / cell_size)
+    cell_y = func.floor(lat / cell_size)
+    rows = db.session.query(
+        cell_x, cell_y, func.count(model.id), func.avg(lng), func.avg(lat)
+        ).filter(bbox_filter(model, south, west, north, east)
+        ).group_by(cell_x, cell_y).all()
+    return [
+        {
+            'cell': '%d:%d:%d' % (zoom, x, y),
+            'count': count,
+            'location': {
+                'lng': centroid_lng,
+                'lat': centroid_lat
+            }
+        } for x, y, count, centroid_lng, centroid_lat in rows
+    ]
+
+ESTIMATE_RADIUS_SQL = '''
+    EXPLAIN (FORMAT JSON) SELECT 1 FROM %s
+    WHERE ST_DWithin(geog, ST_SetSRID(ST_MakePoint(:lng, :lat), :srid)::geography, :radius)
+'''
+
+def estimate_within_radius(model, lat, lng, radius):
+    """Return the planner's estimate of the rows within radius (in meters),
+    from the statistics on the geog column: one round trip, nothing is scanned"""
+    plan = db.session.execute(text(ESTIMATE_RADIUS_SQL % model.__table__.name), {
+        'lat': lat, 'lng': lng, 'srid': SpatialConstants.SRID, 'radius': radius
+        }).scalar()
+    return plan[0]['Plan']['Plan Rows']
+
+def paginate_within_radius(model, lat, lng, radius, cursor=None, limit=PagingConstants.API_PAGE_SIZE):
+    """Return (items, next_cursor) of rows within radius (in meters), nearest first"""
+    query, distance = within_radius_query(model, lat, lng, radius)
+    if cursor:
+        last_distance, last_id = decode_cursor(cursor, float)
+        query = query.filter(tuple_(distance, model.id) > tuple_(last_distance, last_id))
+    rows = query.order_by(distance, model.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(repr(rows[-1][1]), rows[-1][0].id)
+    return [item for item, _ in rows], next_cursor
+
+def page_by_distance(index, lat, lng, radius, cursor=None, limit=PagingConstants.API_PAGE_SIZE):
+    """Like paginate_within_radius, for a GridIndex of spatial_index; returns
+    (distance, id, item) rows"""
+    last = decode_cursor(cursor, float) if cursor else None
+    rows = index.within_radius(lat, lng, radius, last, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(repr(rows[-1][0]), rows[-1][1])
+    return rows, next_cursor
 class Location(db.Model):
     __tablename__ = 'sample_locations'
 
     id = Column(Integer, primary_key=True)
     description = Column(String(80))
     geom = Column(Geometry(geometry_type='POINT', srid=SpatialConstants.SRID))
+    geog = geography_column()
+    latitude = latitude_property(geom)
+    longitude = longitude_property(geom)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False) # <<<
     # many to one side of the relationship of Location with User <<<
     user = db.relationship("User", back_populates="created_locations") # <<<
@@ -104,28 +462,62 @@ class Location(db.Model):
         return wkb_element
 
     @staticmethod
-    def get_items_within_radius(lat, lng, radius):
-        """Return all sample locations within a given radius (in meters)"""
+    def find_or_create(latitude, longitude, description, user_id, work=None):
+        """Return the sample location at exactly this point, creating it if there
+        is none yet, so all posts written at one place share one location.
+        A new location is staged in work (a UnitOfWork) if given, otherwise
+        inserted right away."""
+        point = Location.point_representation(latitude=latitude, longitude=longitude)
+        location = Location.query.filter(
+            Location.geom.intersects(point),
+            func.ST_Equals(Location.geom, point)
+            ).order_by(Location.id).first()
+        if location is None:
+            location = Location(description=description, geom=point, user_id=user_id)
+            if work is None:
+                location.insert()
+            else:
+                work.add(location)
+        return location
+
+    @staticmethod
+    def get_items_within_radius(lat, lng, radius, cursor=None, limit=PagingConstants.API_PAGE_SIZE):
+        """Return a page of sample locations within a given radius (in meters)
+        and the cursor of the next page (None on the last page)"""
+        if spatial_index.ready():
+            rows, next_cursor = page_by_distance(spatial_index.locations, lat, lng, radius, cursor, limit)
+            return [item for _, _, item in rows], next_cursor
+        results, next_cursor = paginate_within_radius(Location, lat, lng, radius, cursor, limit)
+        return [l.to_dict() for l in results], next_cursor
 
-        #TODO: The arbitrary limit = 100 is just a quick way to make sure
-        # we won't return tons of entries at once,
-        # paging needs to be in place for real usecase
-        results = Location.query.filter(
-            ST_DWithin(
-                cast(Location.geom, Geography),
-                cast(from_shape(Point(lng, lat)), Geography),
-                radius)
-            ).limit(100).all()
+    @staticmethod
+    def nearest(lat, lng, k):
+        """Return the k sample locations closest to lat/lng, each with its distance (in meters)"""
+        return [dict(l.to_dict(), distance=distance) for l, distance in nearest_rows(Location, lat, lng, k)]
 
-        return [l.to_dict() for l in results]
+    @staticmethod
+    def get_items_in_bbox_diff(south, west, north, east, known_ids):
+        """Return the sample locations a client showing known_ids has to add
+        and remove to display the given bounding box"""
+        if spatial_index.ready():
+            ids = spatial_index.locations.in_bbox(south, west, north, east)
+            in_view = set(ids[:PagingConstants.BBOX_LIMIT])
+            added = [spatial_index.locations.get(id) for id in sorted(in_view - known_ids)]
+            return ([item for item in added if item is not None], sorted(known_ids - in_view),
+                    len(ids) > PagingConstants.BBOX_LIMIT)
+        added, removed, truncated = diff_in_bbox(Location, south, west, north, east, known_ids)
+        return [l.to_dict() for l in added], removed, truncated
+
+    @staticmethod
+    def get_clusters(south, west, north, east, zoom):
+        """Return sample location counts and centroids per grid cell of the zoom level"""
+        return clusters_in_bbox(Location, south, west, north, east, zoom)
 
     def get_location_latitude(self):
-        point = to_shape(self.geom)
-        return point.y
+        return self.latitude
 
     def get_location_longitude(self):
-        point = to_shape(self.geom)
-        return point.x
+        return self.longitude
 
     def to_dict(self):
         return {
@@ -138,26 +530,46 @@ class Location(db.Model):
         }
 
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        with UnitOfWork() as work:
+            work.add(self)
 
     def delete(self):
+        id = self.id
+        notify_deleted(db.session, 'location', [id])
         db.session.delete(self)
+        bump_data_version()
         db.session.commit()
+        if SpatialIndexConstants.ENABLED:
+            spatial_index.locations.remove(id)
 
     def update(self):
+        bump_data_version()
         db.session.commit()
 
 ################################
 
+# rendered feed pages, keyed by the data version, page and cursor
+feed_cache = LRUCache(CacheConstants.FEED_SIZE, CacheConstants.FEED_TTL)
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     content = db.Column(db.Text, nullable=False)
     geom = Column(Geometry(geometry_type='POINT', srid=SpatialConstants.SRID))
+    geog = geography_column()
+    latitude = latitude_property(geom)
+    longitude = longitude_property(geom)
     # location = db.Column(db.Geometry, nullable=False)
     user_id=db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    description = db.Column(db.String(200), nullable=False) 
+    # words of description and content for full-text search (GIN indexed),
+    # only used in SQL, so not loaded with the post
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "to_tsvector('%s', coalesce(description, '') || ' ' || content)" % SearchConstants.TEXT_SEARCH_CONFIG,
+        persisted=True)))
+    # the place the post was written at, shared by all posts at that point
+    location_id = db.Column(db.Integer, db.ForeignKey('sample_locations.id', ondelete='SET NULL'))
+    location = db.relationship('Location')
+    description = db.Column(db.String(200), nullable=False, index=True)
   
 
     @staticmethod
@@ -169,38 +581,130 @@ class Post(db.Model):
 
     
     @staticmethod
-    def get_items_with_same_geom(geom1):
-        """Return all posts with same geometry"""
-        #TODO: The arbitrary limit = 100 is just a quick way to make sure
-        # we won't return tons of entries at once,
-        # paging needs to be in place for real usecase
-        results = Post.query.filter(Post.geom==geom1).limit(100).all()
-        return [l.to_dict() for l in results]
-    
-        
+    def get_feed(cursor=None, user_id=None, limit=PagingConstants.PAGE_SIZE):
+        """Return a page of posts (newest first) and the cursor of the next page"""
+        query = Post.query
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        return paginate_by_date(query, Post, cursor, limit)
+
+    @staticmethod
+    def get_items_at_location(location_id, cursor=None, limit=PagingConstants.PAGE_SIZE):
+        """Return a page of posts written at a sample location and the cursor of the next page"""
+        results, next_cursor = paginate_by_date(Post.query.filter_by(location_id=location_id), Post, cursor, limit)
+        return [l.to_dict() for l in results], next_cursor
         
     @staticmethod
-    def get_items_within_radius(lat, lng, radius):
-        """Return all posts within a given radius (in meters)"""
-        #TODO: The arbitrary limit = 100 is just a quick way to make sure
-        # we won't return tons of entries at once,
-        # paging needs to be in place for real usecase
-        results = Post.query.filter(
-            ST_DWithin(
-                cast(Post.geom, Geography),
-                cast(from_shape(Point(lng, lat)), Geography),
-                radius)
-            ).limit(100).all()
-        return [l.to_dict() for l in results]
+    def nearest(lat, lng, k):
+        """Return the k posts closest to lat/lng, each with its distance (in meters)"""
+        return [dict(p.to_dict(), distance=distance) for p, distance in nearest_rows(Post, lat, lng, k)]
+
+    @staticmethod
+    def search(terms, lat=None, lng=None, radius=None, cursor=None, limit=PagingConstants.PAGE_SIZE):
+        """Return a page of posts matching the search terms (web search syntax:
+        words, "quoted phrases", -excluded, or), best match first, optionally only
+        within radius (in meters) of lat/lng, and the cursor of the next page"""
+        query = func.websearch_to_tsquery(SearchConstants.TEXT_SEARCH_CONFIG, terms)
+        # ts_rank_cd is a real, compared as such with the float8 of a cursor it
+        # never equals the rank it came from, so rank in float8 throughout
+        rank = cast(func.ts_rank_cd(Post.search_vector, query), Float)
+        results = db.session.query(Post, rank).filter(Post.search_vector.op('@@')(query))
+        if radius is not None:
+            within, _ = radius_filter(Post, lat, lng, radius)
+            results = results.filter(within)
+        if cursor:
+            last_rank, last_id = decode_cursor(cursor, float)
+            results = results.filter(tuple_(rank, Post.id) < tuple_(last_rank, last_id))
+        rows = results.order_by(rank.desc(), Post.id.desc()).limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(repr(rows[-1][1]), rows[-1][0].id)
+        return [post.to_dict() for post, _ in rows], next_cursor
+
+    @staticmethod
+    def get_items_within_radius(lat, lng, radius, cursor=None, limit=PagingConstants.API_PAGE_SIZE):
+        """Return a page of posts within a given radius (in meters)
+        and the cursor of the next page (None on the last page)"""
+        if spatial_index.ready():
+            # the index finds the page, the posts themselves come by primary key
+            rows, next_cursor = page_by_distance(spatial_index.posts, lat, lng, radius, cursor, limit)
+            posts = {p.id: p for p in Post.query.filter(Post.id.in_([id for _, id, _ in rows]))} if rows else {}
+            return [posts[id].to_dict() for _, id, _ in rows if id in posts], next_cursor
+        results, next_cursor = paginate_within_radius(Post, lat, lng, radius, cursor, limit)
+        return [l.to_dict() for l in results], next_cursor
+
+    @staticmethod
+    def export(bbox=None, lat=None, lng=None, radius=None, since=None, until=None, chunk_size=1000):
+        """Yield the posts inside bbox (south, west, north, east), within radius
+        (in meters) of lat/lng and posted in [since, until), whichever are given,
+        in id order, as dicts like to_dict() plus location_id, with ISO dates.
+        Rows come through a server-side cursor chunk_size at a time, so memory
+        stays flat however many posts match."""
+        query = db.session.query(
+            Post.id, Post.date_posted, Post.content, Post.description, Post.location_id,
+            Post.latitude, Post.longitude)
+        if bbox is not None:
+            query = query.filter(bbox_filter(Post, *bbox))
+        if radius is not None:
+            within, _ = radius_filter(Post, lat, lng, radius)
+            query = query.filter(within)
+        if since is not None:
+            query = query.filter(Post.date_posted >= since)
+        if until is not None:
+            query = query.filter(Post.date_posted < until)
+        rows = query.order_by(Post.id).execution_options(stream_results=True).yield_per(chunk_size)
+        for id, date_posted, content, description, location_id, lat, lng in rows:
+            yield {
+                'id': id,
+                'content': content,
+                'date_posted': date_posted.isoformat(),
+                'description': description,
+                'location_id': location_id,
+                'location': {
+                    'lng': lng,
+                    'lat': lat
+                }
+            }
+
+    @staticmethod
+    def time_of_day():
+        """Time-of-day of date_posted truncated to seconds (indexed expression)"""
+        return cast(func.date_trunc('second', Post.date_posted), Time)
+
+    @staticmethod
+    def get_items_posted_on(day, page=1):
+        """Return a page of posts written on the given date (oldest first)"""
+        start = datetime(day.year, day.month, day.day)
+        end = start + timedelta(days=1)
+        return Post.query.filter(
+            Post.date_posted >= start,
+            Post.date_posted < end
+            ).order_by(Post.date_posted, Post.id).paginate(
+                page=page, per_page=PagingConstants.PAGE_SIZE, error_out=False)
+
+    @staticmethod
+    def get_items_posted_at(time_of_day, page=1):
+        """Return a page of posts written at the given time of day (to the second)"""
+        return Post.query.filter(
+            Post.time_of_day() == time_of_day
+            ).order_by(Post.date_posted, Post.id).paginate(
+                page=page, per_page=PagingConstants.PAGE_SIZE, error_out=False)
+
+    @staticmethod
+    def get_items_with_description(description, page=1):
+        """Return a page of posts whose place has the given description"""
+        return Post.query.filter(
+            Post.description == description
+            ).order_by(Post.date_posted.desc(), Post.id.desc()).paginate(
+                page=page, per_page=PagingConstants.PAGE_SIZE, error_out=False)
 
 
     def get_location_latitude(self):
-        point = to_shape(self.geom)
-        return point.y
+        return self.latitude
 
     def get_location_longitude(self):
-        point = to_shape(self.geom)
-        return point.x
+        return self.longitude
 
     def to_dict(self):
         return {
@@ -215,19 +719,369 @@ class Post(db.Model):
         }
 
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        with UnitOfWork() as work:
+            work.add(self)
 
     def delete(self):
+        id = self.id
+        PostDensity.add_posts([id], sign=-1)
+        notify_deleted(db.session, 'post', [id])
         db.session.delete(self)
+        bump_data_version()
         db.session.commit()
+        if SpatialIndexConstants.ENABLED:
+            spatial_index.posts.remove(id)
 
     def update(self):
+        bump_data_version()
         db.session.commit()
 
+# keyset pagination and date ranges walk (date_posted, id)
+db.Index('ix_post_date_posted_id', Post.date_posted, Post.id)
+# posts of one place, newest first (/detail)
+db.Index('ix_post_location_id_date_posted_id', Post.location_id, Post.date_posted, Post.id)
+# full-text search (/search)
+db.Index('ix_post_search_vector', Post.search_vector, postgresql_using='gin')
+# /timely looks posts up by time of day, which needs an expression index
+db.Index('ix_post_time_of_day', Post.time_of_day())
+
+
+'''
+Post counts per grid cell (see grid_cell_size) and day for the zoom levels
+in DensityConstants, kept up to date by Post.insert()/delete() and batch
+imports and rebuilt from scratch by the rebuild-density CLI command (e.g.
+after bulk loads or edits of post coordinates). /api/density reads it
+through the primary key instead of touching the posts.
+'''
+POST_DENSITY_SQL = '''
+    INSERT INTO post_density (zoom, cell_x, cell_y, day, count)
+    SELECT z.zoom,
+           floor(ST_X(p.geom) / (360.0 / (2 ^ z.zoom) / :cells_per_tile))::integer,
+           floor(ST_Y(p.geom) / (360.0 / (2 ^ z.zoom) / :cells_per_tile))::integer,
+           p.date_posted::date,
+           :sign * count(*)
+    FROM post p CROSS JOIN unnest(CAST(:zooms AS integer[])) AS z(zoom)
+    WHERE p.geom IS NOT NULL %s
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (zoom, cell_x, cell_y, day)
+    DO UPDATE SET count = post_density.count + EXCLUDED.count
+'''
+
+class PostDensity(db.Model):
+    __tablename__ = 'post_density'
+
+    zoom = db.Column(db.SmallInteger, primary_key=True)
+    cell_x = db.Column(db.Integer, primary_key=True)
+    cell_y = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def add_posts(post_ids, sign=1):
+        """Add (or with sign=-1 remove) the given posts to the counts, in the
+        current transaction"""
+        db.session.execute(text(POST_DENSITY_SQL % 'AND p.id = ANY(:ids)'), {
+            'ids': list(post_ids),
+            'sign': sign,
+            'zooms': list(DensityConstants.ZOOM_LEVELS),
+            'cells_per_tile': ClusterConstants.CELLS_PER_TILE
+        })
+
+    @staticmethod
+    def rebuild():
+        """Recount all posts in one transaction"""
+        db.session.execute(text('DELETE FROM post_density'))
+        db.session.execute(text(POST_DENSITY_SQL % ''), {
+            'sign': 1,
+            'zooms': list(DensityConstants.ZOOM_LEVELS),
+            'cells_per_tile': ClusterConstants.CELLS_PER_TILE
+        })
+        bump_data_version()
+        db.session.commit()
+
+    @staticmethod
+    def get_cells(south, west, north, east, zoom, since=None, until=None):
+        """Return the post count per grid cell inside a bounding box at a zoom
+        level (snapped to the nearest kept level), optionally only for posts
+        written between the dates since and until (inclusive)"""
+        zoom = min(max(zoom, DensityConstants.ZOOM_LEVELS[0]), DensityConstants.ZOOM_LEVELS[-1])
+        cell_size = grid_cell_size(zoom)
+        low_y, high_y = int(south // cell_size), int(north // cell_size)
+        if west <= east:
+            x_ranges = [(int(west // cell_size), int(east // cell_size))]
+        else:
+            x_ranges = [(int(west // cell_size), int(180 // cell_size)), (int(-180 // cell_size), int(east // cell_size))]
+
+        query = db.session.query(
+            PostDensity.cell_x, PostDensity.cell_y, func.sum(PostDensity.count)
+            ).filter(
+                PostDensity.zoom == zoom,
+                or_(*[PostDensity.cell_x.between(low_x, high_x) for low_x, high_x in x_ranges]),
+                PostDensity.cell_y.between(low_y, high_y))
+        if since is not None:
+            query = query.filter(PostDensity.day >= since)
+        if until is not None:
+            query = query.filter(PostDensity.day <= until)
+        rows = query.group_by(PostDensity.cell_x, PostDensity.cell_y).having(func.sum(PostDensity.count) > 0).all()
+        return [
+            {
+                'cell': '%d:%d:%d' % (zoom, x, y),
+                'count': int(count),
+                'location': {
+                    'lng': (x + 0.5) * cell_size,
+                    'lat': (y + 0.5) * cell_size
+                }
+            } for x, y, count in rows
+        ]
+
+'''
+Links posts to the sample location at their exact point, creating missing
+locations from the first post at a point. Used by the link-posts CLI command
+to backfill posts written before Post.location_id existed and by batch
+imports. Works on an id range so large tables are done in short transactions.
+'''
+LINK_POSTS_SQL = [
+    '''
+    INSERT INTO sample_locations (description, geom, user_id)
+    SELECT DISTINCT ON (p.geom) left(p.description, 80), p.geom, p.user_id
+    FROM post p
+    WHERE p.location_id IS NULL AND p.geom IS NOT NULL
+      AND p.id BETWEEN :low AND :high
+      AND NOT EXISTS (
+        SELECT 1 FROM sample_locations l
+        WHERE l.geom && p.geom AND ST_Equals(l.geom, p.geom))
+    ORDER BY p.geom, p.id
+    ''',
+    '''
+    UPDATE post p SET location_id = (
+        SELECT l.id FROM sample_locations l
+        WHERE l.geom && p.geom AND ST_Equals(l.geom, p.geom)
+        ORDER BY l.id LIMIT 1)
+    WHERE p.location_id IS NULL AND p.geom IS NOT NULL
+      AND p.id BETWEEN :low AND :high
+    '''
+]
+
+def link_posts_to_locations(low_id, high_id):
+    """Link the unlinked posts with ids in [low_id, high_id], commit and
+    return how many posts were linked"""
+    linked = 0
+    for statement in LINK_POSTS_SQL:
+        linked = db.session.execute(text(statement), {'low': low_id, 'high': high_id}).rowcount
+    # new sample locations may have been created for the posts
+    bump_data_version()
+    db.session.commit()
+    return linked
+
+def backfill_post_locations(batch_size=10000):
+    """Link all unlinked posts, batch_size ids per transaction; yield the
+    number of posts linked per batch"""
+    low, high = db.session.query(func.min(Post.id), func.max(Post.id)).filter(Post.location_id.is_(None)).one()
+    if low is None:
+        return
+    for start in range(low, high + 1, batch_size):
+        yield link_posts_to_locations(start, start + batch_size - 1)
+
+'''
+Batch import of locations and posts, used by /api/store_items and the
+import-items CLI command. Items are validated one by one, then each chunk
+is written with multi-row INSERTs in a single transaction. A bad item only
+produces an error entry for its index; if the database rejects a chunk,
+its rows are retried one per transaction to single out the bad ones.
+'''
+class IngestConstants:
+    CHUNK_SIZE = 1000
+    # seconds write_behind waits to gather more items before a flush
+    WRITE_BEHIND_DELAY = 0.5
+    # items write_behind holds before it starts turning writers away
+    WRITE_BEHIND_QUEUE_SIZE = 10000
+
+def parse_ingest_item(item):
+    """Return (model, row) for one item of a batch import, raise ValueError if it is invalid"""
+    if isinstance(item, ValueError):
+        # lines that could not be parsed arrive as their error
+        raise item
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+
+    kind = item.get('type', 'location')
+    if kind not in ('location', 'post'):
+        raise ValueError('type must be location or post')
+    try:
+        latitude = float(item['lat'])
+        longitude = float(item['lng'])
+        user_id = int(item['user_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('lat, lng and user_id are required numbers')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('coordinates out of range')
+
+    description = item.get('description')
+    if description is not None and not isinstance(description, str):
+        raise ValueError('description must be a string')
+    row = {
+        'geom': Location.point_representation(latitude=latitude, longitude=longitude),
+        'user_id': user_id,
+        'description': description
+    }
+    if kind == 'location':
+        if description is not None and len(description) > 80:
+            raise ValueError('description is longer than 80 characters')
+        return Location, row
+
+    content = item.get('content')
+    if not content or not isinstance(content, str) or not description:
+        raise ValueError('posts need content and description')
+    if len(description) > 200:
+        raise ValueError('description is longer than 200 characters')
+    row['content'] = content
+    try:
+        date_posted = item.get('date_posted')
+        row['date_posted'] = datetime.fromisoformat(date_posted) if date_posted else datetime.utcnow()
+    except (TypeError, ValueError):
+        raise ValueError('date_posted must be an ISO 8601 timestamp')
+    return Post, row
+
+def insert_batch(items):
+    """Insert a chunk of (index, item) pairs and return one result dict per item,
+    {'index': i, 'id': new_id} or {'index': i, 'error': message}"""
+    results = {}
+    staged = {Location: [], Post: []}
+    for index, item in items:
+        try:
+            model, row = parse_ingest_item(item)
+            staged[model].append((index, row))
+        except ValueError as e:
+            results[index] = {'index': index, 'error': str(e)}
+
+    user_ids = set(row['user_id'] for rows in staged.values() for _, row in rows)
+    known_user_ids = set(id for id, in db.session.query(User.id).filter(User.id.in_(user_ids))) if user_ids else set()
+    for model, rows in staged.items():
+        for index, row in rows:
+            if row['user_id'] not in known_user_ids:
+                results[index] = {'index': index, 'error': 'unknown user_id'}
+        staged[model] = [(index, row) for index, row in rows if row['user_id'] in known_user_ids]
+
+    try:
+        for model, rows in staged.items():
+            if rows:
+                statement = insert(model.__table__).returning(model.__table__.c.id)
+                ids = db.session.execute(statement, [row for _, row in rows]).scalars().all()
+                for (index, _), id in zip(rows, ids):
+                    results[index] = {'index': index, 'id': id}
+        bump_data_version()
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        for model, rows in staged.items():
+            statement = insert(model.__table__).returning(model.__table__.c.id)
+            for index, row in rows:
+                try:
+                    id = db.session.execute(statement, row).scalar()
+                    db.session.commit()
+                    results[index] = {'index': index, 'id': id}
+                except SQLAlchemyError as e:
+                    db.session.rollback()
+                    results[index] = {'index': index, 'error': 'rejected by the database: %s' % getattr(e, 'orig', e)}
+
+    location_ids = [results[index]['id'] for index, _ in staged[Location] if 'id' in results[index]]
+    if location_ids:
+        notify_inserted(db.session, 'location', location_ids)
+        bump_data_version()
+        db.session.commit()
+    post_ids = [results[index]['id'] for index, _ in staged[Post] if 'id' in results[index]]
+    if post_ids:
+        link_posts_to_locations(min(post_ids), max(post_ids))
+        PostDensity.add_posts(post_ids)
+        notify_inserted(db.session, 'post', post_ids)
+        bump_data_version()
+        db.session.commit()
+    return [results[index] for index in sorted(results)]
+
+def insert_in_chunks(items, chunk_size=IngestConstants.CHUNK_SIZE):
+    """Insert items (any iterable, read lazily) chunk by chunk and yield the result of each item"""
+    chunk = []
+    for index, item in enumerate(items):
+        chunk.append((index, item))
+        if len(chunk) == chunk_size:
+            yield from insert_batch(chunk)
+            chunk = []
+    if chunk:
+        yield from insert_batch(chunk)
+
+
+'''
+Write-behind for high-rate API writers: items (in the format of
+parse_ingest_item) are queued and written by one thread per worker through
+insert_batch, a chunk per transaction, instead of a transaction per request.
+Queued items are lost if the worker dies before they are flushed, and
+invalid ones are only logged, so this is for writers that can live with that.
+'''
+logger = logging.getLogger(__name__)
+
+class WriteBehind:
+    def __init__(self):
+        self._queue = queue.Queue(IngestConstants.WRITE_BEHIND_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._app = None
+
+    def submit(self, app, item):
+        """Queue an item, return False if the queue is full"""
+        with self._lock:
+            if self._thread is None:
+                self._app = app
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def _take(self, timeout=None):
+        chunk = []
+        try:
+            chunk.append(self._queue.get(timeout=timeout))
+            while len(chunk) < IngestConstants.CHUNK_SIZE:
+                chunk.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return chunk
+
+    def _write(self, chunk):
+        try:
+            with self._app.app_context():
+                for result in insert_batch(list(enumerate(chunk))):
+                    if 'error' in result:
+                        logger.warning('write-behind item dropped: %s', result['error'])
+        except Exception:
+            logger.exception('write-behind lost %d items', len(chunk))
+
+    def _run(self):
+        while True:
+            chunk = self._take()
+            # give other writers a moment to join this transaction
+            time.sleep(IngestConstants.WRITE_BEHIND_DELAY)
+            chunk.extend(self._take(timeout=0))
+            self._write(chunk)
+
+    def flush(self):
+        """Write everything still queued, in this thread"""
+        while True:
+            chunk = self._take(timeout=0)
+            if not chunk:
+                return
+            self._write(chunk)
+
+write_behind = WriteBehind()
+
   
   
-  
+# users loaded by the login manager, see User.get_cached
+user_cache = LRUCache(CacheConstants.USERS_SIZE, CacheConstants.USERS_TTL)
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
 
@@ -244,6 +1098,21 @@ class User(UserMixin, db.Model):
     def get_by_id(cls, user_id):
         return cls.query.filter_by(id=user_id).first()
 
+    @classmethod
+    def get_cached(cls, user_id):
+        """Like get_by_id, but served from user_cache without a query when possible.
+        The cache holds detached copies that are merged into the current session."""
+        user_id = int(user_id)
+        cached = user_cache.get(user_id)
+        if cached is None:
+            user = cls.get_by_id(user_id)
+            if user is None:
+                return None
+            cached = cls(**{column.key: getattr(user, column.key) for column in cls.__table__.columns})
+            make_transient_to_detached(cached)
+            user_cache.set(user_id, cached)
+        return db.session.merge(cached, load=False)
+
     def __repr__(self):
         return f"User({self.id}, '{self.email}')"
 
@@ -252,8 +1121,12 @@ class User(UserMixin, db.Model):
         db.session.commit()
 
     def delete(self):
+        user_id = self.id
         db.session.delete(self)
         db.session.commit()
+        user_cache.delete(user_id)
 
     def update(self):
-        db.session.commit()
\ No newline at end of file
+        user_id = self.id
+        db.session.commit()
+        user_cache.delete(user_id)
\ No newline at end of file
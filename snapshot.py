@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import mmap
+import math
+import struct
+import tempfile
+import shutil
+from array import array
+from datetime import datetime, timezone
+
+
+class SnapshotConstants:
+    MAGIC = b'KDSNAP1\0'
+    # rows fetched per round trip while writing
+    CHUNK_SIZE = 10000
+    # every column starts at a multiple of this, so it can be cast in place
+    ALIGNMENT = 8
+
+
+'''
+A snapshot is one file of columns, written by the export-snapshot CLI
+command and mapped into memory by load_snapshot without copying:
+
+    MAGIC | header length (8 bytes) | JSON header | columns, each aligned to 8 bytes
+
+The header names every column with its array typecode, offset and length in
+items. Numbers are native-endian arrays ('q' int64, 'd' float64); a missing
+point is NaN, a missing location_id -1, dates are UTC seconds since the
+epoch. A text column is a 'q' array of n + 1 offsets into a UTF-8 blob
+('B'), row i is blob[offsets[i]:offsets[i + 1]] (a missing text is empty).
+
+    locations: id, lat, lng, user_id, description
+    posts:     id, lat, lng, date_posted, user_id, location_id, description, content
+'''
+TABLES = {
+    'locations': {'id': 'q', 'lat': 'd', 'lng': 'd', 'user_id': 'q', 'description': str},
+    'posts': {'id': 'q', 'lat': 'd', 'lng': 'd', 'date_posted': 'd', 'user_id': 'q',
+              'location_id': 'q', 'description': str, 'content': str}
+}
+
+
+class TextColumn:
+    """Offsets in memory, the blob in a temporary file until it is written out"""
+
+    def __init__(self):
+        self.offsets = array('q', [0])
+        self.blob = tempfile.TemporaryFile()
+
+    def append(self, text):
+        data = (text or '').encode('utf-8')
+        self.blob.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+
+def epoch_seconds(date):
+    return date.replace(tzinfo=timezone.utc).timestamp()
+
+def coordinate(value):
+    return math.nan if value is None else value
+
+def write_snapshot(path, chunk_size=SnapshotConstants.CHUNK_SIZE):
+    """Write all sample locations and posts to a snapshot file at path
+    (replaced atomically) and return the number of (locations, posts)"""
+    from models import db, Location, Post
+    columns = {}
+    for table, fields in TABLES.items():
+        for field, typecode in fields.items():
+            columns['%s.%s' % (table, field)] = TextColumn() if typecode is str else array(typecode)
+
+    locations = db.session.query(
+        Location.id, Location.latitude, Location.longitude, Location.user_id, Location.description
+        ).order_by(Location.id).yield_per(chunk_size)
+    for id, lat, lng, user_id, description in locations:
+        columns['locations.id'].append(id)
+        columns['locations.lat'].append(coordinate(lat))
+        columns['locations.lng'].append(coordinate(lng))
+        columns['locations.user_id'].append(user_id)
+        columns['locations.description'].append(description)
+
+    posts = db.session.query(
+        Post.id, Post.latitude, Post.longitude, Post.date_posted, Post.user_id,
+        Post.location_id, Post.description, Post.content
+        ).order_by(Post.id).yield_per(chunk_size)
+    for id, lat, lng, date_posted, user_id, location_id, description, content in posts:
+        columns['posts.id'].append(id)
+        columns['posts.lat'].append(coordinate(lat))
+        columns['posts.lng'].append(coordinate(lng))
+        columns['posts.date_posted'].append(epoch_seconds(date_posted))
+        columns['posts.user_id'].append(user_id)
+        columns['posts.location_id'].append(-1 if location_id is None else location_id)
+        columns['posts.description'].append(description)
+        columns['posts.content'].append(content)
+
+    # flatten text columns into their offsets and blob
+    sections = []
+    for name, column in columns.items():
+        if isinstance(column, TextColumn):
+            sections.append((name + '.offsets', 'q', column.offsets))
+            sections.append((name + '.blob', 'B', column.blob))
+        else:
+            sections.append((name, column.typecode, column))
+
+    def size(typecode, data):
+        if typecode == 'B':
+            return data.seek(0, os.SEEK_END)
+        return len(data)
+
+    def aligned(offset):
+        return -(-offset // SnapshotConstants.ALIGNMENT) * SnapshotConstants.ALIGNMENT
+
+    # the header holds offsets that depend on its own length, grow it until it fits
+    header_size = 0
+    while True:
+        offset = aligned(len(SnapshotConstants.MAGIC) + 8 + header_size)
+        layout = {}
+        for name, typecode, data in sections:
+            count = size(typecode, data)
+            layout[name] = [typecode, offset, count]
+            offset = aligned(offset + count * array(typecode).itemsize)
+        header = json.dumps({
+            'byteorder': sys.byteorder,
+            'created': datetime.utcnow().isoformat(),
+            'columns': layout
+        }).encode('utf-8')
+        if len(header) <= header_size:
+            break
+        header_size = len(header) + 64
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SnapshotConstants.MAGIC)
+        f.write(struct.pack('<Q', header_size))
+        f.write(header.ljust(header_size))
+        for name, typecode, data in sections:
+            f.write(b'\0' * (layout[name][1] - f.tell()))
+            if typecode == 'B':
+                data.seek(0)
+                shutil.copyfileobj(data, f)
+                data.close()
+            else:
+                data.tofile(f)
+    os.replace(tmp_path, path)
+    return len(columns['locations.id']), len(columns['posts.id'])
+
+
+class SnapshotTable:
+    """The columns of one table: numeric columns are memoryviews on the file
+    (e.g. table.lat[i]), text(name, i) decodes one text"""
+
+    def __init__(self, snapshot, table):
+        self._snapshot = snapshot
+        self._table = table
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getattr__(self, field):
+        try:
+            return self._snapshot.columns['%s.%s' % (self._table, field)]
+        except KeyError:
+            raise AttributeError(field)
+
+    def text(self, field, i):
+        offsets = self._snapshot.columns['%s.%s.offsets' % (self._table, field)]
+        blob = self._snapshot.columns['%s.%s.blob' % (self._table, field)]
+        return bytes(blob[offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def rows(self):
+        """Yield every row as a dict (this copies, use the columns for bulk work)"""
+        fields = TABLES[self._table]
+        for i in range(len(self)):
+            yield {
+                field: self.text(field, i) if typecode is str else getattr(self, field)[i]
+                for field, typecode in fields.items()
+            }
+
+
+class Snapshot:
+    """A snapshot file mapped read-only into memory. Use as a context manager
+    or call close(); the columns must not be used after that."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic_size = len(SnapshotConstants.MAGIC)
+        if bytes(self._view[:magic_size]) != SnapshotConstants.MAGIC:
+            self.close()
+            raise ValueError('%s is not a snapshot' % path)
+        header_size, = struct.unpack_from('<Q', self._map, magic_size)
+        header_start = magic_size + 8
+        self.header = json.loads(bytes(self._view[header_start:header_start + header_size]))
+        if self.header['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError('%s was written on a %s-endian machine' % (path, self.header['byteorder']))
+        self.columns = {}
+        for name, (typecode, offset, count) in self.header['columns'].items():
+            end = offset + count * array(typecode).itemsize
+            self.columns[name] = self._view[offset:end].cast(typecode)
+        self.locations = SnapshotTable(self, 'locations')
+        self.posts = SnapshotTable(self, 'posts')
+
+    def close(self):
+        for column in getattr(self, 'columns', {}).values():
+            column.release()
+        self.columns = {}
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_snapshot(path):
+    """Map a snapshot written by write_snapshot"""
+    return Snapshot(path)
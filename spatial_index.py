@@ -0,0 +1,476 @@
+import os
+import math
+import queue
+import threading
+import time
+import heapq
+import bisect
+import logging
+from array import array
+from collections import defaultdict
+from events import item_events
+
+
+logger = logging.getLogger(__name__)
+
+
+class SpatialIndexConstants:
+    # SPATIAL_INDEX=1 answers radius and bbox queries from memory, anything
+    # else (the default) sends them to PostGIS as before
+    ENABLED = os.getenv('SPATIAL_INDEX', '0') == '1'
+    # edge of a grid cell in degrees (about 1 km north-south)
+    CELL_SIZE = 0.01
+    # every RECONCILE_SECONDS the next RECONCILE_CHUNK rows of each table
+    # (by id) are compared with the index, which picks up anything the NOTIFY
+    # events missed: a million posts are gone through in about 7 minutes
+    RECONCILE_SECONDS = 2
+    RECONCILE_CHUNK = 5000
+    # changed points kept next to the arrays before they are merged into them
+    COMPACT_SIZE = 10000
+    # a snapshot file (see snapshot.py) to fill the index from at start,
+    # before the first load from the database
+    SNAPSHOT = os.getenv('SPATIAL_INDEX_SNAPSHOT')
+    # rows fetched per round trip while loading
+    LOAD_CHUNK = 10000
+    # mean earth radius in meters, distances are measured on this sphere
+    EARTH_RADIUS = 6371008.8
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """Great-circle (haversine) distance in meters. PostGIS measures geography
+    on the spheroid, the two differ by up to 0.5%."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * SpatialIndexConstants.EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def in_box(box, lat, lng):
+    """True if lat/lng is inside box (south, west, north, east; west > east
+    for boxes crossing the antimeridian)"""
+    south, west, north, east = box
+    if not south <= lat <= north:
+        return False
+    if west <= east:
+        return west <= lng <= east
+    return lng >= west or lng <= east
+
+
+class PointArrays:
+    """Points sorted by id in parallel arrays (8 bytes per id and coordinate),
+    and the slots of the points in every occupied grid cell. Never changed
+    once built; items are kept in a list only if the index has items."""
+
+    def __init__(self, cell, entries, with_items):
+        self.ids = array('q')
+        self.lats = array('d')
+        self.lngs = array('d')
+        self.items = [] if with_items else None
+        self.cells = defaultdict(lambda: array('q'))  # (x, y) -> slots
+        for slot, (id, lat, lng, item) in enumerate(entries):
+            self.ids.append(id)
+            self.lats.append(lat)
+            self.lngs.append(lng)
+            if self.items is not None:
+                self.items.append(item)
+            self.cells[cell(lat, lng)].append(slot)
+        self.cells = dict(self.cells)
+
+    def slot(self, id):
+        """The slot of id, None if it is not here"""
+        slot = bisect.bisect_left(self.ids, id)
+        if slot < len(self.ids) and self.ids[slot] == id:
+            return slot
+        return None
+
+    def point(self, slot):
+        return self.lats[slot], self.lngs[slot], self.items[slot] if self.items is not None else None
+
+    def entries(self, changes):
+        """Yield (id, lat, lng, item) ascending, with changes (id -> point or
+        None for removed) applied"""
+        added = sorted((id, point) for id, point in changes.items() if point is not None)
+        i = 0
+        for slot, id in enumerate(self.ids):
+            while i < len(added) and added[i][0] < id:
+                yield (added[i][0],) + added[i][1]
+                i += 1
+            if id not in changes:
+                yield (id,) + self.point(slot)
+        for id, point in added[i:]:
+            yield (id,) + point
+
+
+class GridIndex:
+    """Thread-safe points (id -> lat, lng and an optional item) bucketed into
+    a fixed lat/lng grid. Most points sit in PointArrays, changes since they
+    were built in a small dict on top of them, which the loader thread merges
+    into new arrays (compact()) once it holds COMPACT_SIZE points. A query
+    only looks at the cells its area touches; if those are more than the
+    occupied cells, it looks at all of them."""
+
+    def __init__(self, cell_size=SpatialIndexConstants.CELL_SIZE, with_items=False):
+        self.cell_size = cell_size
+        self.columns = int(round(360 / cell_size))
+        self.rows = int(round(180 / cell_size))
+        self.with_items = with_items
+        self._base = PointArrays(self._cell, [], with_items)
+        self._changes = {}  # id -> (lat, lng, item), None if removed from the base
+        self._changed_cells = defaultdict(set)  # (x, y) -> ids of changed points
+        self._lock = threading.Lock()
+        # counts changes, part of the ETag of responses served from the index
+        self.version = 0
+
+    def __len__(self):
+        with self._lock:
+            count = len(self._base.ids)
+            for id, point in self._changes.items():
+                in_base = self._base.slot(id) is not None
+                count += (point is not None) - in_base
+            return count
+
+    @property
+    def changes(self):
+        """Number of changes not merged into the arrays yet"""
+        return len(self._changes)
+
+    def _cell(self, lat, lng):
+        x = int(math.floor((lng + 180) / self.cell_size)) % self.columns
+        y = min(int(math.floor((lat + 90) / self.cell_size)), self.rows - 1)
+        return x, y
+
+    def _point(self, id):
+        """(lat, lng, item) of id or None, call with the lock held"""
+        if id in self._changes:
+            return self._changes[id]
+        slot = self._base.slot(id)
+        return self._base.point(slot) if slot is not None else None
+
+    def _forget_change(self, id):
+        point = self._changes.pop(id, None)
+        if point is not None:
+            cell = self._cell(point[0], point[1])
+            self._changed_cells[cell].discard(id)
+            if not self._changed_cells[cell]:
+                del self._changed_cells[cell]
+
+    def add(self, id, lat, lng, item=None):
+        with self._lock:
+            if self._point(id) == (lat, lng, item):
+                return
+            self._forget_change(id)
+            self._changes[id] = (lat, lng, item)
+            self._changed_cells[self._cell(lat, lng)].add(id)
+            self.version += 1
+
+    def remove(self, id):
+        with self._lock:
+            if self._point(id) is None:
+                return
+            self._forget_change(id)
+            if self._base.slot(id) is not None:
+                self._changes[id] = None
+            self.version += 1
+
+    def replace(self, entries):
+        """Swap the contents for (id, lat, lng, item) entries, ascending by id"""
+        base = PointArrays(self._cell, entries, self.with_items)
+        with self._lock:
+            self._base, self._changes, self._changed_cells = base, {}, defaultdict(set)
+            self.version += 1
+
+    def compact(self):
+        """Merge the changes into new arrays. They are built without holding
+        the lock; changes made meanwhile stay on top of the new arrays."""
+        with self._lock:
+            base, changes = self._base, dict(self._changes)
+        merged = PointArrays(self._cell, base.entries(changes), self.with_items)
+        with self._lock:
+            pending, changed_cells = {}, defaultdict(set)
+            for id, point in self._changes.items():
+                if id in changes and changes[id] is point:
+                    continue
+                if point is not None:
+                    pending[id] = point
+                    changed_cells[self._cell(point[0], point[1])].add(id)
+                elif merged.slot(id) is not None:
+                    pending[id] = None
+            self._base, self._changes, self._changed_cells = merged, pending, changed_cells
+
+    def get(self, id):
+        with self._lock:
+            point = self._point(id)
+        return point[2] if point is not None else None
+
+    def points_between(self, low, high):
+        """id -> (lat, lng, item) of the points with low < id <= high (no upper
+        bound if high is None)"""
+        with self._lock:
+            base = self._base
+            start = bisect.bisect_right(base.ids, low)
+            end = len(base.ids) if high is None else bisect.bisect_right(base.ids, high)
+            points = {base.ids[slot]: base.point(slot) for slot in range(start, end)}
+            for id, point in self._changes.items():
+                if low < id and (high is None or id <= high):
+                    if point is None:
+                        points.pop(id, None)
+                    else:
+                        points[id] = point
+        return points
+
+    def reconcile(self, low, high, rows):
+        """Make the points with low < id <= high (no upper bound if high is
+        None) those of rows, (id, lat, lng, item) read from the database"""
+        points = self.points_between(low, high)
+        for id, lat, lng, item in rows:
+            if points.pop(id, None) != (lat, lng, item):
+                self.add(id, lat, lng, item)
+        for id in points:
+            self.remove(id)
+
+    def _cells_in_box(self, cells, south, west, north, east):
+        """The values of cells ((x, y) -> points) touching the box (all if
+        they are fewer than the cells of the box, west > east for boxes
+        crossing the antimeridian), call with the lock held"""
+        x0, y0 = self._cell(south, west)
+        x1, y1 = self._cell(north, east)
+        width = (x1 - x0) % self.columns + 1
+        if west <= east and east - west >= 360 - self.cell_size:
+            width = self.columns
+        if width * (y1 - y0 + 1) > len(cells):
+            return list(cells.values())
+        return [cells[key] for key in (
+            ((x0 + dx) % self.columns, y) for dx in range(width) for y in range(y0, y1 + 1)
+            ) if key in cells]
+
+    def _candidates(self, south, west, north, east):
+        """The arrays and a dict of changes to look at for the box, and the
+        changed points (id, lat, lng, item) in it. The arrays never change and
+        the dict is only read by id, so both are used without the lock."""
+        with self._lock:
+            base, changes = self._base, self._changes
+            slots = self._cells_in_box(base.cells, south, west, north, east)
+            changed = [(id,) + changes[id]
+                       for ids in self._cells_in_box(self._changed_cells, south, west, north, east)
+                       for id in ids]
+        return base, slots, changes, changed
+
+    @staticmethod
+    def radius_box(lat, lng, radius):
+        """(south, west, north, east) of a box around the circle"""
+        dlat = math.degrees(radius / SpatialIndexConstants.EARTH_RADIUS)
+        south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+        cos_lat = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+        if north >= 90 or south <= -90 or cos_lat <= 0 or dlat / cos_lat >= 180:
+            return south, -180.0, north, 180.0
+        dlng = dlat / cos_lat
+        return south, (lng - dlng + 180) % 360 - 180, north, (lng + dlng + 180) % 360 - 180
+
+    def estimate_within_radius(self, lat, lng, radius):
+        """Number of points a radius query has to look at (those in the cells
+        touching the circle), counted without measuring any distance"""
+        box = self.radius_box(lat, lng, radius)
+        with self._lock:
+            return (sum(len(slots) for slots in self._cells_in_box(self._base.cells, *box)) +
+                    sum(len(ids) for ids in self._cells_in_box(self._changed_cells, *box)))
+
+    def within_radius(self, lat, lng, radius, after=None, count=None):
+        """Return (distance, id, item) of the points within radius (in meters),
+        nearest first: only those after the (distance, id) of a cursor if
+        given, and only the first count if given. Distances are measured
+        without holding the lock."""
+        box = self.radius_box(lat, lng, radius)
+        base, cells, changes, changed = self._candidates(*box)
+
+        def matches():
+            ids, lats, lngs, items = base.ids, base.lats, base.lngs, base.items
+            for slots in cells:
+                for slot in slots:
+                    point_lat, point_lng = lats[slot], lngs[slot]
+                    if not in_box(box, point_lat, point_lng) or ids[slot] in changes:
+                        continue
+                    d = distance(lat, lng, point_lat, point_lng)
+                    if d <= radius and (after is None or (d, ids[slot]) > after):
+                        yield d, ids[slot], items[slot] if items is not None else None
+            for id, point_lat, point_lng, item in changed:
+                if in_box(box, point_lat, point_lng):
+                    d = distance(lat, lng, point_lat, point_lng)
+                    if d <= radius and (after is None or (d, id) > after):
+                        yield d, id, item
+
+        # ids are unique, items are never compared
+        if count is None:
+            return sorted(matches())
+        return heapq.nsmallest(count, matches())
+
+    def in_bbox(self, south, west, north, east):
+        """Return the ids of the points inside a bounding box, ascending"""
+        box = south, west, north, east
+        base, cells, changes, changed = self._candidates(*box)
+
+        ids = [base.ids[slot] for slots in cells for slot in slots
+               if in_box(box, base.lats[slot], base.lngs[slot]) and base.ids[slot] not in changes]
+        ids.extend(id for id, lat, lng, _ in changed if in_box(box, lat, lng))
+        return sorted(ids)
+
+
+def location_item(id, description, lat, lng):
+    """The to_dict() of a sample location"""
+    return {
+        'id': id,
+        'description': description,
+        'location': {
+            'lng': lng,
+            'lat': lat
+        }
+    }
+
+
+class SpatialIndex:
+    """In-memory copy of the points of all sample locations and posts of this
+    worker, used instead of PostGIS for radius and bbox queries once loaded.
+    Writes in this worker update it at once, writes in other workers arrive
+    through the NOTIFY events (see events.py), and a walk over both tables by
+    id, RECONCILE_CHUNK rows at a time, fixes whatever those missed. One
+    thread per worker does the loading, started by start() from gunicorn's
+    post_fork or by the first query."""
+
+    def __init__(self):
+        self.locations = GridIndex(with_items=True)
+        self.posts = GridIndex()
+        self._app = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        # the last id reconciled of each table, 0 to start over
+        self._reconciled = {'locations': 0, 'posts': 0}
+
+    def init_app(self, app):
+        self._app = app
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self._app is not None and SpatialIndexConstants.ENABLED:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def ready(self):
+        """True if queries can be answered from the index; until the first load
+        is done they go to the database"""
+        if not SpatialIndexConstants.ENABLED:
+            return False
+        if self._thread is None:
+            self.start()
+        return self._loaded.is_set()
+
+    @property
+    def generation(self):
+        """Changes whenever the index of this worker changes"""
+        return self.locations.version + self.posts.version
+
+    def add_location(self, id, description, lat, lng):
+        self.locations.add(id, lat, lng, location_item(id, description, lat, lng))
+
+    def add_post(self, id, lat, lng):
+        self.posts.add(id, lat, lng)
+
+    def _apply(self, event):
+        location = event.get('location') or {}
+        if event.get('type') == 'location':
+            self.add_location(event['id'], event.get('description'), location['lat'], location['lng'])
+        elif event.get('type') == 'post':
+            self.add_post(event['id'], location['lat'], location['lng'])
+        elif event.get('type') == 'location_deleted':
+            self.locations.remove(event['id'])
+        elif event.get('type') == 'post_deleted':
+            self.posts.remove(event['id'])
+
+    def _rows(self, table, after, limit=None):
+        """(id, lat, lng, item) of the rows of table with a point and an id
+        above after, ascending, at most limit of them"""
+        from models import db, Location, Post
+        model = Location if table == 'locations' else Post
+        columns = [model.id, model.latitude, model.longitude]
+        if model is Location:
+            columns.append(Location.description)
+        query = db.session.query(*columns).filter(
+            model.geom.isnot(None), model.id > after).order_by(model.id)
+        if limit is not None:
+            query = query.limit(limit)
+        for row in query.yield_per(SpatialIndexConstants.LOAD_CHUNK):
+            if model is Location:
+                id, lat, lng, description = row
+                yield id, lat, lng, location_item(id, description, lat, lng)
+            else:
+                yield row[0], row[1], row[2], None
+
+    def _load(self):
+        with self._app.app_context():
+            self.locations.replace(self._rows('locations', 0))
+            self.posts.replace(self._rows('posts', 0))
+        self._loaded.set()
+        logger.info('spatial index loaded: %d locations, %d posts', len(self.locations), len(self.posts))
+
+    def _load_snapshot(self, path):
+        from snapshot import load_snapshot
+        with load_snapshot(path) as snapshot:
+            locations, posts = snapshot.locations, snapshot.posts
+            self.locations.replace(
+                (id, lat, lng, location_item(id, locations.text('description', i), lat, lng))
+                for i, (id, lat, lng) in enumerate(zip(locations.id, locations.lat, locations.lng))
+                if not math.isnan(lat))
+            self.posts.replace(
+                (id, lat, lng, None) for id, lat, lng in zip(posts.id, posts.lat, posts.lng)
+                if not math.isnan(lat))
+        self._loaded.set()
+        logger.info('spatial index loaded from %s: %d locations, %d posts', path, len(self.locations), len(self.posts))
+
+    def _reconcile(self):
+        """Compare the next RECONCILE_CHUNK rows of both tables with the
+        index and fix what differs; True when the posts start over"""
+        for table, index in (('locations', self.locations), ('posts', self.posts)):
+            after = self._reconciled[table]
+            with self._app.app_context():
+                rows = list(self._rows(table, after, SpatialIndexConstants.RECONCILE_CHUNK))
+            # a short chunk is the end of the table, it covers every id above
+            last = rows[-1][0] if len(rows) == SpatialIndexConstants.RECONCILE_CHUNK else None
+            index.reconcile(after, last, rows)
+            self._reconciled[table] = last or 0
+        return self._reconciled['posts'] == 0
+
+    def _run(self):
+        # subscribed before loading, so nothing written during a load is missed
+        subscription = item_events.subscribe(self._app, -90, -180, 90, 180)
+        if SpatialIndexConstants.SNAPSHOT:
+            try:
+                self._load_snapshot(SpatialIndexConstants.SNAPSHOT)
+            except Exception:
+                logger.exception('loading %s failed', SpatialIndexConstants.SNAPSHOT)
+        # a snapshot is ready at once, the first round of reconciling brings
+        # it up to date without pausing between chunks
+        catching_up = self._loaded.is_set()
+        reconcile_at = 0
+        while True:
+            try:
+                if time.monotonic() >= reconcile_at:
+                    if not self._loaded.is_set():
+                        self._load()
+                    elif self._reconcile():
+                        catching_up = False
+                    reconcile_at = time.monotonic() + (0 if catching_up else SpatialIndexConstants.RECONCILE_SECONDS)
+                try:
+                    event = subscription.get(timeout=max(reconcile_at - time.monotonic(), 0))
+                    while True:
+                        self._apply(event)
+                        event = subscription.get(timeout=0)
+                except queue.Empty:
+                    pass
+                for index in (self.locations, self.posts):
+                    if index.changes >= SpatialIndexConstants.COMPACT_SIZE:
+                        index.compact()
+            except Exception:
+                logger.exception('updating the spatial index failed, trying again')
+                reconcile_at = time.monotonic() + 5
+
+
+spatial_index = SpatialIndex()
@@ -1,10 +1,33 @@
 let map;
-let markers;
+// markers currently shown in the map, keyed by item id
+let markers = {};
 
 let geocoder;
 
-let queryCenter;
-let queryZoom;
+// cluster markers shown instead of single markers when zoomed out
+let clusterMarkers = [];
+
+// up to this zoom the backend groups items into clusters,
+// keep in sync with ClusterConstants.MAX_ZOOM in models.py
+var CLUSTER_MAX_ZOOM = 12;
+
+// live stream of new items inside the loaded area (Server-Sent Events):
+// one per page, reopened for every newly loaded area
+let itemStream = null;
+
+// the area whose markers were loaded last, when, and whether all of them
+// fit in the answer; while the stream is open it keeps new items of that
+// area coming, so views inside it need no request for a while
+let loadedBounds = null;
+let loadedAt = 0;
+let loadedComplete = false;
+
+// deletes and moves are not streamed, the loaded area is asked for again
+// after this many milliseconds
+var LOADED_MAX_AGE = 60000;
+
+// every refresh gets a number, so late answers to older requests are ignored
+let refreshCount = 0;
 
 //When the user clicks on a marker, it will become
 // the selected one:
@@ -37,33 +60,16 @@ function initMap() {
   });
 
   google.maps.event.addListener(map, "idle", function () {
-    var newZoom = map.getZoom();
-    var newCenter = map.getCenter();
-
     console.log(
-      "Map  event triggers, zoom:" + newZoom + ", center: " + newCenter
+      "Map  event triggers, zoom:" + map.getZoom() + ", center: " + map.getCenter()
     );
 
-    // We want to avoid re-rendering the markers if the change
-    // in position within the map is too small. Also, if we are zooming in
-    // without changing the center significantly, there is also no need
-    // to call the backend again for new points
-    var distanceChange =
-      queryCenter == null
-        ? 0
-        : google.maps.geometry.spherical.computeDistanceBetween(
-            queryCenter,
-            newCenter
-          );
-
-    if (
-      queryCenter == null ||
-      queryZoom == null ||
-      distanceChange > 100 ||
-      newZoom < queryZoom
-    ) {
-      //if we have not queried for markers yet, query
-      refreshMarkers(newCenter, newZoom);
+    // The backend only answers with the markers that changed for the visible
+    // area, and nothing is asked while the view stays inside the loaded area
+    if (map.getZoom() <= CLUSTER_MAX_ZOOM) {
+      refreshClusters(map.getBounds(), map.getZoom());
+    } else if (!isLoaded(map.getBounds())) {
+      refreshMarkers(map.getBounds());
     }
   });
 
@@ -125,49 +131,22 @@ function initMap() {
   };
 }
 
-var radiusToZoomLevel = [
-  800000, // zoom: 0
-  800000, // zoom: 1
-  800000, // zoom: 2
-  800000, // zoom: 3
-  800000, // zoom: 4
-  800000, // zoom: 5
-  800000, // zoom: 6
-  400000, // zoom: 7
-  200000, // zoom: 8
-  100000, // zoom: 9
-  51000, // zoom: 10
-  26000, // zoom: 11
-  13000, // zoom: 12
-  6500, // zoom: 13
-  3500, // zoom: 14
-  1800, // zoom: 15
-  900, // zoom: 16
-  430, // zoom: 17
-  210, // zoom: 18
-  120, // zoom: 19
-];
-
-function refreshMarkers(mapCenter, zoomLevel) {
+function refreshMarkers(bounds) {
   console.log("refreshing markers");
-  //Update query cener and zoom so we know in referenec to what
-  //we queried for markers the last time and can decide if a re-query is needed
-  queryCenter = mapCenter;
-  queryZoom = zoomLevel;
-
-  // If we had already some markers in the map, we need to clear them
-  clearMarkers();
+  var requestNumber = ++refreshCount;
 
-  // This will helpt to understand the radius, its for debug only
-  //createCircle(mapCenter,radiusToZoomLevel[zoomLevel]);
-
-  // we call the backend to get the list of markers
+  // we send the ids we already show, the backend answers with the markers
+  // to add and the ids to remove for the new viewport
+  var southWest = bounds.getSouthWest();
+  var northEast = bounds.getNorthEast();
   var params = {
-    lat: mapCenter.lat(),
-    lng: mapCenter.lng(),
-    radius: radiusToZoomLevel[zoomLevel],
+    south: southWest.lat(),
+    west: southWest.lng(),
+    north: northEast.lat(),
+    east: northEast.lng(),
+    known: Object.keys(markers).join(","),
   };
-  var url = "/api/get_items_in_radius?" + dictToURI(params);
+  var url = "/api/get_items_in_bbox?" + dictToURI(params);
   loadJSON(url, function (response) {
     // Parse JSON string into object
     var response_JSON = JSON.parse(response);
@@ -175,21 +154,135 @@ function refreshMarkers(mapCenter, zoomLevel) {
 
     if (!response_JSON.success) {
       // something failed in the backed serching for the items
-      console.log("/api/get_items_in_radius call FAILED!");
+      console.log("/api/get_items_in_bbox call FAILED!");
+      return;
+    }
+
+    // the map moved on while we were loading, a newer diff is on its way
+    if (requestNumber != refreshCount) {
       return;
     }
 
-    // place new markers in the map
-    placeItemsInMap(response_JSON.results);
+    clearClusters();
+    removeMarkers(response_JSON.removed);
+    placeItemsInMap(response_JSON.added);
+    loadedBounds = bounds;
+    loadedAt = Date.now();
+    loadedComplete = !response_JSON.truncated;
+    followNewItems(bounds);
+  });
+}
+
+function isLoaded(bounds) {
+  return (
+    loadedBounds !== null &&
+    loadedComplete &&
+    Date.now() - loadedAt < LOADED_MAX_AGE &&
+    // refused (503), failed or reconnecting streams may have missed items
+    itemStream !== null &&
+    itemStream.readyState === EventSource.OPEN &&
+    loadedBounds.contains(bounds.getSouthWest()) &&
+    loadedBounds.contains(bounds.getNorthEast())
+  );
+}
+
+function refreshClusters(bounds, zoomLevel) {
+  console.log("refreshing clusters");
+  var requestNumber = ++refreshCount;
+
+  var southWest = bounds.getSouthWest();
+  var northEast = bounds.getNorthEast();
+  var params = {
+    south: southWest.lat(),
+    west: southWest.lng(),
+    north: northEast.lat(),
+    east: northEast.lng(),
+    zoom: zoomLevel,
+  };
+  var url = "/api/get_clusters?" + dictToURI(params);
+  loadJSON(url, function (response) {
+    var response_JSON = JSON.parse(response);
+
+    if (!response_JSON.success) {
+      console.log("/api/get_clusters call FAILED!");
+      return;
+    }
+
+    if (requestNumber != refreshCount) {
+      return;
+    }
+
+    clearMarkers();
+    clearClusters();
+    placeClustersInMap(response_JSON.clusters);
+    loadedBounds = null;
+    followNewItems(bounds);
+  });
+}
+
+function placeClustersInMap(clusters) {
+  clusterMarkers = clusters.map(function (cluster) {
+    var marker = new google.maps.Marker({
+      map: map,
+      position: cluster.location,
+      label: String(cluster.count),
+    });
+
+    // zoom into the cluster until it splits into single markers
+    google.maps.event.addListener(marker, "click", function (evt) {
+      map.setCenter(this.getPosition());
+      map.setZoom(map.getZoom() + 2);
+    });
+
+    return marker;
+  });
+}
+
+function clearClusters() {
+  clusterMarkers.forEach(function (marker) {
+    marker.setMap(null);
+  });
+  clusterMarkers = [];
+}
+
+function boundsToDict(bounds) {
+  var southWest = bounds.getSouthWest();
+  var northEast = bounds.getNorthEast();
+  return {
+    south: southWest.lat(),
+    west: southWest.lng(),
+    north: northEast.lat(),
+    east: northEast.lng(),
+  };
+}
+
+function followNewItems(bounds) {
+  // one long-lived connection per page pushes locations created while the
+  // map is open. It is reopened for the new area rather than moved, the
+  // next request could reach another worker than the one holding it
+  if (!window.EventSource) {
+    return;
+  }
+  if (itemStream) {
+    itemStream.close();
+  }
+
+  itemStream = new EventSource("/api/stream?" + dictToURI(boundsToDict(bounds)));
+  itemStream.addEventListener("location", function (event) {
+    // when zoomed out the clusters are refreshed on the next pan instead
+    if (map.getZoom() > CLUSTER_MAX_ZOOM) {
+      placeItemsInMap([JSON.parse(event.data)]);
+    }
   });
 }
 
 function placeItemsInMap(items) {
   // Add some markers to the map.
-  // Note: The code uses the JavaScript Array.prototype.map() method to
-  // create an array of markers based on the given "items" array.
-  // The map() method here has nothing to do with the Google Maps API.
-  markers = items.map(function (item, i) {
+  items.forEach(function (item) {
+    if (markers[item.id]) {
+      return;
+    }
+
     var marker = new google.maps.Marker({
       map: map,
       position: item.location,
@@ -205,22 +298,32 @@ function placeItemsInMap(items) {
       markerClick(this);
     });
 
-    return marker;
+    markers[item.id] = marker;
   });
+}
 
-  /*console.log(markers);
-    console.log(markers.length);*/
+function removeMarkers(ids) {
+  ids.forEach(function (id) {
+    var marker = markers[id];
+    if (!marker) {
+      return;
+    }
+
+    if (marker === selectedMarker) {
+      selectedMarker = null;
+      if (selectedMarkerPopup) {
+        selectedMarkerPopup.setMap(null);
+        selectedMarkerPopup = null;
+      }
+    }
+
+    marker.setMap(null);
+    delete markers[id];
+  });
 }
 
 function clearMarkers() {
-  if (markers) {
-    markers.map(function (marker, i) {
-      marker.setMap(null);
-    });
-  }
-
-  markers = new Array();
-  selectedMarker = null;
+  removeMarkers(Object.keys(markers));
 }
 
 function searchAddressSubmit() {
@@ -0,0 +1,37 @@
+// Turns <time class="timeago" datetime="..."> elements into relative
+// "5 minutes ago" text in the browser. The server renders absolute times
+// only, so cached feed HTML never goes stale.
+
+var TIMEAGO_UNITS = [
+  ["year", 365 * 24 * 3600],
+  ["month", 30 * 24 * 3600],
+  ["week", 7 * 24 * 3600],
+  ["day", 24 * 3600],
+  ["hour", 3600],
+  ["minute", 60],
+];
+
+function timeago(date) {
+  var seconds = Math.max(0, (Date.now() - date.getTime()) / 1000);
+  for (var i = 0; i < TIMEAGO_UNITS.length; i++) {
+    var count = Math.floor(seconds / TIMEAGO_UNITS[i][1]);
+    if (count >= 1) {
+      return count + " " + TIMEAGO_UNITS[i][0] + (count > 1 ? "s" : "") + " ago";
+    }
+  }
+  return "just now";
+}
+
+function updateTimeago() {
+  document.querySelectorAll("time.timeago").forEach(function (element) {
+    var date = new Date(element.getAttribute("datetime"));
+    if (!isNaN(date)) {
+      element.textContent = timeago(date);
+    }
+  });
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+  updateTimeago();
+  setInterval(updateTimeago, 60 * 1000);
+});